@@ -1,18 +1,130 @@
 import os
+import shutil
 import sqlite3
-import pandas as pd
+import threading
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import metrics
 
 # This database contains kaggle data from https://www.kaggle.com/datasets/gdaley/hkracing/data
 # The data is used for random races and user-generated races
 # This is the data used for creating the 1-8 ratings
 # There is a runs table and a races table, which can be joined through the race_id column
 # Each race in tRaces has an id, and each observation in tRuns is an individual horse's result from a given race
+# pandas is only imported by the methods that need it, so tracks loaded from snapshots never import it
+
+class QueryCache:
+    # Query results only change when the database is rebuilt, so they are shared by every HorseDB in the process
+    # Results are keyed by database, query, and distance. Once maxsize results are stored, the least recently used one is dropped
+    def __init__(self, maxsize=18): # Three queries for each of the six valid distances
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock() # Streamlit sessions run in separate threads
+        return
+    
+    def get(self, key, load):
+        """
+        Returns the result stored under key, calling load() to get it if it isn't stored yet.
+        Results are shared, so they should not be modified.
+        """
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return self.results[key]
+            self.misses += 1
+        result = load() # Queries run outside the lock so other distances aren't blocked
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+        return result
+    
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+        return
+    
+    def info(self):
+        """Returns the cache's hit and miss counts and its current and max size."""
+        with self.lock:
+            return {'hits':self.hits, 'misses':self.misses, 'size':len(self.results), 'maxsize':self.maxsize}
+
+class ConnectionPool:
+    # Reusable read-only connections to a database, shared by every HorseDB in the process
+    # At most size connections are opened, if they are all in use, callers wait for one to be returned
+    def __init__(self, path_db, size=4):
+        self.path_db = path_db
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        return
+    
+    def open(self):
+        conn = sqlite3.connect(f'file:{self.path_db}?mode=ro', uri=True, check_same_thread=False)
+        conn.execute('PRAGMA cache_size = -32000') # 32 MB page cache per connection
+        conn.execute('PRAGMA temp_store = MEMORY') # Window function and GROUP BY sorts stay in memory
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Lends out a connection for the duration of a with block."""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                if can_open:
+                    self.opened += 1
+            if can_open:
+                try:
+                    conn = self.open()
+                except sqlite3.Error:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+            else:
+                conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+    
+    def close(self):
+        """Closes the idle connections, connections in use are closed when the pool is emptied again."""
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.lock:
+                self.opened -= 1
+        return
 
 class HorseDB:
-    def __init__(self):
-        self.path_data = os.path.join(os.path.dirname(__file__), 'data')
+    # Columns kept from the csvs with the dtype they are read with and their type in the database
+    RUNS_COLUMNS = {'race_id':('int32', 'INTEGER'), 'horse_no':('int32', 'INTEGER'), 'horse_id':('int32', 'INTEGER'), 
+                    'time1':('float32', 'REAL'), 'time2':('float32', 'REAL'), 'time3':('float32', 'REAL'), 
+                    'time4':('float32', 'REAL'), 'time5':('float32', 'REAL'), 'time6':('float32', 'REAL'), 
+                    'finish_time':('float32', 'REAL')}
+    RACES_COLUMNS = {'race_id':('int32', 'INTEGER'), 'surface':('category', 'INTEGER'), 
+                     'distance':('int32', 'INTEGER'), 'going':('category', 'TEXT')}
+    CHUNK_SIZE = 100000 # Rows of a csv read at a time when rebuilding the database
+    CACHE = QueryCache()
+    POOLS = {} # Connection pool for each database path
+    POOLS_LOCK = threading.Lock()
+    PATH_DATA = os.path.join(os.path.dirname(__file__), 'data') # Folder holding the csvs, database, and snapshots
+    
+    def __init__(self, path_data=None):
+        self.path_data = path_data or self.PATH_DATA
         self.path_db = os.path.join(self.path_data, 'horses.db')
-        print()
         return
     
     def connect(self):
@@ -24,45 +136,195 @@ class HorseDB:
         self.conn.close()
         return
     
-    def open_data(self):
-        path_runs = os.path.join(self.path_data, 'runs.csv') # Data for individual horses
-        path_races = os.path.join(self.path_data, 'races.csv') # Data for each race
-        runs = pd.read_csv(path_runs)
-        races = pd.read_csv(path_races)
-        return runs, races
+    def get_pool(self):
+        with self.POOLS_LOCK:
+            if self.path_db not in self.POOLS:
+                self.POOLS[self.path_db] = ConnectionPool(self.path_db)
+            return self.POOLS[self.path_db]
+    
+    def open_data(self, file_name, columns):
+        """
+        Returns an iterator over CHUNK_SIZE row chunks of a csv in the data folder.
+        Only the given columns are read, using the given compact dtypes.
+        """
+        import pandas as pd
+        path = os.path.join(self.path_data, file_name)
+        dtypes = {name:dtype for name, (dtype, _) in columns.items()}
+        for chunk in pd.read_csv(path, usecols=list(columns), dtype=dtypes, chunksize=self.CHUNK_SIZE):
+            yield chunk[list(columns)]
     
     def get_tables(self):
-        '''Processes and returns tRuns and tRaces'''
-        runs, races = self.open_data()
-        # Drop unnecessary columns
-        runs_reduced = runs[['race_id', 'horse_no', 'horse_id', 'time1','time2', 'time3', 'time4', 'time5', 'time6', 'finish_time']]
-        races_reduced = races[['race_id', 'surface', 'distance', 'going']]
-        # Remove outliers from sectional times (anything over 50 seconds will be considered an outlier)
-        runs_reduced = runs_reduced[runs_reduced['time3'] < 50]
-        runs_reduced = runs_reduced[runs_reduced['time2'] < 50]
-        runs_reduced = runs_reduced[runs_reduced['time1'] < 50]
-        return runs_reduced, races_reduced
+        '''Returns iterators over processed chunks of tRuns and tRaces'''
+        runs = (self.remove_outliers(chunk) for chunk in self.open_data('runs.csv', self.RUNS_COLUMNS)) # Data for individual horses
+        races = self.open_data('races.csv', self.RACES_COLUMNS) # Data for each race
+        return runs, races
+    
+    def remove_outliers(self, runs):
+        '''Removes outliers from sectional times (anything over 50 seconds will be considered an outlier)'''
+        runs = runs[(runs['time3'] < 50) & (runs['time2'] < 50) & (runs['time1'] < 50)]
+        return runs
+    
+    def insert_chunks(self, table, columns, chunks):
+        """Creates a table with the given columns and inserts every chunk into it."""
+        types = ', '.join(f'"{name}" {sql_type}' for name, (_, sql_type) in columns.items())
+        self.curs.execute(f"CREATE TABLE {table} ({types});")
+        sql = f"INSERT INTO {table} VALUES ({', '.join('?'*len(columns))});"
+        for chunk in chunks:
+            # Times are recorded to the hundredth of a second, rounding removes the float32 error before storing them
+            values = [chunk[name].astype('float64').round(2) if columns[name][0] == 'float32' else chunk[name] for name in columns]
+            # SQLite needs python values (NaN is stored as NULL)
+            self.curs.executemany(sql, zip(*(column.tolist() for column in values)))
+        return
     
     def rebuild_db(self):
         self.connect()
-        runs_reduced, races_reduced = self.get_tables()
+        self.curs.execute("PRAGMA journal_mode = WAL;").fetchone() # Readers don't block on (or get blocked by) a rebuild
+        runs, races = self.get_tables()
+        # The csvs are streamed into the database in one transaction, so memory use is bounded by CHUNK_SIZE
+        self.curs.execute("BEGIN;")
         self.curs.execute("DROP TABLE IF EXISTS tRuns;")
         self.curs.execute("DROP TABLE IF EXISTS tRaces;")
-        runs_reduced.to_sql('tRuns', 
-                    self.conn,
-                    index=False)
-        races_reduced.to_sql('tRaces', 
-                    self.conn,
-                    index=False)
+        self.insert_chunks('tRuns', self.RUNS_COLUMNS, runs)
+        self.insert_chunks('tRaces', self.RACES_COLUMNS, races)
+        self.conn.commit()
+        self.build_aggregates()
+        self.create_indexes()
         self.close()
+        self.get_pool().close() # Pooled connections were opened on the old tables
+        self.CACHE.clear() # Stored query results are from the old database
+        shutil.rmtree(os.path.join(self.path_data, 'snapshot'), ignore_errors=True) # So are snapshots
         return
     
+    def build_aggregates(self):
+        """
+        Materializes the data Track needs for every distance, so reading it is a keyed lookup.
+        These only change when the database is rebuilt. Only horses that have run a distance
+        10 or more times are included for that distance.
+            tUngrouped: each horse's sectional and total times
+            tGrouped: the average of each horse's top 3 times
+            tHorseStats: the standard deviation of each horse's meters per second (mps_std) and how 
+                         much their mps drops from section 2 to the last section (time_diff)
+        """
+        import pandas as pd
+        self.curs.execute("DROP TABLE IF EXISTS tUngrouped;")
+        self.curs.execute("DROP TABLE IF EXISTS tGrouped;")
+        self.curs.execute("DROP TABLE IF EXISTS tHorseStats;")
+        self.curs.execute("""
+            CREATE TABLE tUngrouped AS
+            WITH horses_dist AS 
+            (
+              SELECT distance, horse_id, time1, time2, time3, time4, time5, time6, finish_time,
+                  count(horse_id) OVER (PARTITION BY distance, horse_id) AS num_races
+              FROM tRuns 
+              JOIN tRaces USING(race_id)
+            )
+            SELECT distance, horse_id, time1, time2, time3, time4, time5, time6, finish_time
+            FROM horses_dist
+            WHERE num_races >= 10
+            ORDER BY distance, horse_id
+            ;""")
+        self.curs.execute("""
+            CREATE TABLE tGrouped AS
+            WITH ranked_times AS 
+            (
+              SELECT distance, horse_id, finish_time, 
+                  ROW_NUMBER() OVER (PARTITION BY distance, horse_id ORDER BY finish_time) AS row_num,
+                  count(horse_id) OVER (PARTITION BY distance, horse_id) AS num_races
+              FROM tRuns 
+              JOIN tRaces USING(race_id)
+            )
+            SELECT distance, horse_id, num_races, avg(finish_time) as top_speed
+            FROM ranked_times
+            WHERE row_num <= 3
+                AND num_races >= 10
+            GROUP BY distance, horse_id
+            ;""")
+        self.conn.commit()
+        distances = [row[0] for row in self.curs.execute("SELECT DISTINCT distance FROM tUngrouped ORDER BY distance;").fetchall()]
+        stats = []
+        for distance in distances: # One distance is loaded at a time to bound memory
+            times_dist = pd.read_sql("SELECT * FROM tUngrouped WHERE distance = :distance;", self.conn, params={'distance':distance})
+            # Number of sections recorded in a race of this distance
+            num_sects = distance // 400 + (distance % 400 > 50)
+            last_sect = 'time' + str(num_sects)
+            horse_times = pd.DataFrame({'horse_id':times_dist['horse_id'],
+                                        'mps_std':distance/times_dist['finish_time'], # Get meters per second
+                                        'time_diff':400/times_dist[last_sect] - 400/times_dist['time2']})
+            horse_stats = horse_times.groupby('horse_id', as_index=False).agg({'mps_std':'std', 'time_diff':'mean'})
+            horse_stats.insert(0, 'distance', distance)
+            stats.append(horse_stats)
+        if not stats: # No horse has run any distance 10 times (like the snip csvs), so the table is left empty
+            stats = [pd.DataFrame({'distance':pd.Series(dtype='int64'), 'horse_id':pd.Series(dtype='int64'),
+                                   'mps_std':pd.Series(dtype='float64'), 'time_diff':pd.Series(dtype='float64')})]
+        pd.concat(stats).to_sql('tHorseStats', self.conn, index=False)
+        return
+    
+    def create_indexes(self):
+        """
+        Indexes the columns the queries filter and join on, then has SQLite gather
+        statistics so the query planner uses them.
+        """
+        self.curs.execute("CREATE INDEX IF NOT EXISTS idx_races_distance ON tRaces(distance, race_id);")
+        self.curs.execute("CREATE INDEX IF NOT EXISTS idx_runs_race ON tRuns(race_id);")
+        self.curs.execute("CREATE INDEX IF NOT EXISTS idx_runs_horse ON tRuns(horse_id);")
+        self.curs.execute("CREATE INDEX IF NOT EXISTS idx_ungrouped_distance ON tUngrouped(distance, horse_id);")
+        self.curs.execute("CREATE INDEX IF NOT EXISTS idx_grouped_distance ON tGrouped(distance, horse_id);")
+        self.curs.execute("CREATE INDEX IF NOT EXISTS idx_stats_distance ON tHorseStats(distance, horse_id);")
+        self.curs.execute("ANALYZE;")
+        self.conn.commit()
+        return
+    
+    @metrics.timed('db_query')
     def run_query(self, sql, params=None):
-        self.connect()
-        results = pd.read_sql(sql, self.conn, params=params)
-        self.close()
+        import pandas as pd
+        metrics.count('db_queries')
+        with self.get_pool().connection() as conn:
+            results = pd.read_sql(sql, conn, params=params)
         return results
     
+    def save_snapshot(self, distance, arrays):
+        """
+        Writes a dictionary of arrays to the distance's snapshot folder as .npy files.
+        Dataframes are stored as structured arrays with a field for each column.
+        """
+        import pandas as pd
+        path = os.path.join(self.path_data, 'snapshot', str(distance))
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, array in arrays.items():
+            if isinstance(array, pd.DataFrame): # Columns with only nulls are read as objects, which can't be memory mapped
+                array = array.apply(pd.to_numeric).to_records(index=False)
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+        # The finished folder replaces the old one, so a partly written snapshot is never loaded. The old folder is
+        # moved aside before it's deleted, so a process loading it at the same time sees all of it or none of it
+        old_path = path + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.isdir(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        return
+    
+    def load_snapshot(self, distance, names=()):
+        """
+        Returns a dictionary of the arrays in the distance's snapshot, or None if there isn't one (or it's missing
+        any of the arrays in names, e.g. while it's being replaced). Arrays are memory mapped, so they are only
+        read when used and processes share their pages.
+        """
+        path = os.path.join(self.path_data, 'snapshot', str(distance))
+        try:
+            arrays = {file[:-4]:np.load(os.path.join(path, file), mmap_mode='r') 
+                      for file in os.listdir(path) if file.endswith('.npy')}
+        except FileNotFoundError: # No snapshot, or it was replaced while it was being read
+            return None
+        return arrays if all(name in arrays for name in names) else None
+    
+    def cached_query(self, name, sql, params):
+        """Returns the results of a query from the shared cache, running the query if they aren't stored."""
+        key = (self.path_db, name, tuple(sorted(params.items())))
+        return self.CACHE.get(key, lambda: self.run_query(sql, params))
+    
     def get_grouped_data(self, distance):
         """
         Returns a dataframe containing the average of each individual horse's top 3
@@ -71,22 +333,13 @@ class HorseDB:
         """
         
         sql = """
-            WITH ranked_times AS 
-            (
-              SELECT horse_id, finish_time, ROW_NUMBER() OVER (PARTITION BY horse_id ORDER BY finish_time) AS row_num
-              FROM tRuns 
-              JOIN tRaces USING(race_id)
-              WHERE distance = :distance
-            )
-            SELECT horse_id, num_races, avg(finish_time) as top_speed
-            FROM (SELECT horse_id, count(horse_id) as num_races FROM ranked_times GROUP BY horse_id)
-            JOIN ranked_times USING(horse_id)
-            WHERE row_num <= 3
-                AND num_races >= 10
-            GROUP BY horse_id
+            SELECT horse_id, num_races, top_speed
+            FROM tGrouped
+            WHERE distance = :distance
+            ORDER BY horse_id
             ;"""
         
-        return self.run_query(sql, distance)
+        return self.cached_query('grouped', sql, distance)
     
     def get_ungrouped_data(self, distance):
         """
@@ -96,19 +349,26 @@ class HorseDB:
         """
         
         sql = """
-            WITH horses_dist AS 
-            (
-              SELECT horse_id, time1, time2, time3, time4, time5, time6, finish_time
-              FROM tRuns 
-              JOIN tRaces USING(race_id)
-              WHERE distance = :distance
-            )
             SELECT horse_id, time1, time2, time3, time4, time5, time6, finish_time
-            FROM (SELECT horse_id, count(horse_id) as num_races FROM horses_dist GROUP BY horse_id)
-            JOIN horses_dist USING(horse_id)
-            WHERE num_races >= 10
+            FROM tUngrouped
+            WHERE distance = :distance
+            ORDER BY horse_id
+            ;"""
+        
+        return self.cached_query('ungrouped', sql, distance)
+    
+    def get_horse_stats(self, distance):
+        """
+        Returns each horse's standard deviation in meters per second and average drop in 
+        meters per second from section 2 to the last section at a given distance. This 
+        only includes horses that have run the given distance 10 or more times.
+        """
+        
+        sql = """
+            SELECT horse_id, mps_std, time_diff
+            FROM tHorseStats
+            WHERE distance = :distance
             ORDER BY horse_id
             ;"""
         
-        return self.run_query(sql, distance)
-        
\ No newline at end of file
+        return self.cached_query('horse_stats', sql, distance)
@@ -0,0 +1,154 @@
+import sys
+import csv
+import json
+import argparse
+import contextlib
+import numpy as np
+import metrics
+from race import Horse, Track, Race
+
+# Prices whole race cards without the website, run with `python batch.py card.json > odds.jsonl`
+# Races are grouped by distance so each Track is loaded once, and all of a distance's races are simulated
+# by the same engine calls. Each race's odds are written as one JSON line as soon as its distance is done.
+#
+# JSON input is a list of races (or one race per line):
+#     {"race": "R1", "distance": 1200, "horses": [{"name": "Horse A", "speed": 5, "consistency": 4, "endurance": 6},
+#                                                  {"name": "Real Horse"}]}
+# CSV input has one row per horse, with columns race, distance, name, speed, consistency, endurance
+# Horses without ratings are real horses, and their data is fetched from horseracingnation.com
+
+RATINGS = ('speed', 'consistency', 'endurance')
+MAX_RUNS = Race.SIM_CHUNK*20 # Most horse runs per engine call, the same as one chunk of a 20 horse race
+
+def read_races(path):
+    '''Returns a list of race dictionaries from a JSON, JSON lines, or CSV file. A path of '-' reads JSON from stdin.'''
+    if path.endswith('.csv'):
+        races = {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                race = races.setdefault(row['race'], {'race': row['race'], 'distance': row['distance'], 'horses': []})
+                race['horses'].append({key: value for key, value in row.items() if key in ('name',) + RATINGS and value})
+        return list(races.values())
+    with (sys.stdin if path == '-' else open(path)) as f:
+        text = f.read()
+    try:
+        races = json.loads(text)
+    except json.JSONDecodeError: # JSON lines
+        races = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return races if isinstance(races, list) else [races]
+
+def create_horses(race, fits):
+    '''Returns the race's Horse objects, using the saved parameters (see horse_params.py) for real horses.'''
+    horses = []
+    for horse in race['horses']:
+        if all(rating in horse for rating in RATINGS):
+            horses.append(Horse(horse['name'], *(int(horse[rating]) for rating in RATINGS)))
+        else:
+            horses.append(Horse(horse['name'], real_horse=True, fit=fits[horse['name']]))
+    return horses
+
+def group_by_distance(races):
+    '''Returns a dictionary of races for each distance, in the order the distances first come up.'''
+    groups = {}
+    for number, race in enumerate(races, start=1):
+        race.setdefault('race', number)
+        groups.setdefault(float(race['distance']), []).append(race)
+    return groups
+
+def split_group(races, sims):
+    '''Splits a distance's races into batches that keep each engine call near MAX_RUNS horse runs.'''
+    batch, width = [], 0
+    for race in races:
+        if batch and (width + len(race.horses))*sims > MAX_RUNS:
+            yield batch
+            batch, width = [], 0
+        batch.append(race)
+        width += len(race.horses)
+    if batch:
+        yield batch
+
+def price_batch(races, track, sims, rng, exact):
+    '''Simulates races at the same track together, saving each race's counts and odds on the race.'''
+    params = np.hstack([race.get_params() for race in races])
+    fields = [len(race.horses) for race in races]
+    # Each chunk of simulations holds about MAX_RUNS horse runs across every race
+    chunk_size = max(1, MAX_RUNS//params.shape[1])
+    counts = Race.count_races(params, fields, track.distance, sims, chunk_size, rng, exact)
+    for race, result in zip(races, counts):
+        race.results = result
+        race.odds = race.wins_to_odds(result['wins'], sims)
+    return
+
+def get_markets(race):
+    '''Returns a priced race's bet probabilities (see Race.get_bet_probabilities), with exacta and trifecta keys joined by |.'''
+    bets = race.get_bet_probabilities()
+    for market in ('exacta', 'trifecta'): # JSON keys have to be strings
+        bets[market] = {'|'.join(names): p for names, p in bets[market].items()}
+    return bets
+
+def to_record(race_id, race, markets):
+    '''Returns the JSON-ready output for a priced race.'''
+    record = {'race': race_id, 'distance': race.track.distance, 'sims': race.sims,
+              'odds': {name: list(odds) for name, odds in race.odds.items()}}
+    if markets:
+        record['markets'] = get_markets(race)
+    return record
+
+def price_card(races, sims=1000, seed=None, exact=None, markets=False, offline=None):
+    '''
+    Prices a list of race dictionaries (see read_races), yielding each race's odds (or error) as a dictionary.
+    Races come out grouped by distance. With a seed, the same card always gets the same odds.
+    Odds use exact finish times unless exact is False (by default, as Race.EXACT_ODDS says).
+    '''
+    if exact is None:
+        exact = Race.EXACT_ODDS
+    # Every real horse on the card is looked up (and fetched, if their saved parameters are missing or old) at once
+    real_names = {horse['name'] for race in races for horse in race['horses'] if not all(r in horse for r in RATINGS)}
+    fits = {}
+    if real_names:
+        from horse_params import PARAMS # Cards without real horses never open the parameter store
+        fits = PARAMS.get_fits(sorted(real_names), offline)
+    for group, (distance, distance_races) in enumerate(group_by_distance(races).items()):
+        track = Track(int(distance) if distance.is_integer() else distance)
+        priced = []
+        for race in distance_races:
+            try:
+                horses = create_horses(race, fits)
+                priced_race = Race(horses, track, len(horses), sims=sims, seed=seed, exact=exact, get_odds=False)
+                priced_race.get_params() # Created horses at a distance without data fail here instead of in the batch
+            except ValueError as error: # Real horses with no data, or created horses at a distance with no data
+                yield {'race': race['race'], 'distance': track.distance, 'error': str(error)}
+                continue
+            priced.append((race['race'], priced_race))
+        rng = None if seed is None else np.random.default_rng([seed, group])
+        for batch in split_group([race for _, race in priced], sims):
+            price_batch(batch, track, sims, rng, exact)
+        for race_id, race in priced:
+            yield to_record(race_id, race, markets)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prices race cards, writing each race's odds as a line of JSON.")
+    parser.add_argument('card', help="JSON, JSON lines, or CSV file of races ('-' reads JSON from stdin)")
+    parser.add_argument('--sims', type=int, default=1000, help='simulations per race')
+    parser.add_argument('--seed', type=int, default=None, help='seed for reproducible odds')
+    parser.add_argument('--exact', action='store_true', default=None, help='use exact finish times (engine.run_exact, the default)')
+    parser.add_argument('--ticks', dest='exact', action='store_false', help='use one second ticks (engine.run) instead of exact finish times')
+    parser.add_argument('--markets', action='store_true', help='include win/place/show/exacta/trifecta chances')
+    parser.add_argument('--offline', action='store_true', help="price real horses from their saved parameters without fetching them")
+    parser.add_argument('--metrics', default=None, help='file to write timings to in the Prometheus text format')
+    args = parser.parse_args(argv)
+    if args.metrics:
+        metrics.enable()
+    out = sys.stdout
+    # Anything else printed along the way goes to stderr so the output stays valid JSON lines
+    with contextlib.redirect_stdout(sys.stderr):
+        for record in price_card(read_races(args.card), args.sims, args.seed, args.exact, args.markets,
+                                 args.offline or None):
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+    if args.metrics:
+        metrics.write_prometheus(args.metrics)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+import utils
+import scraper
+from scraper import HorseFetcher
+from HorseDB import HorseDB
+from race import Horse, Track, Race
+
+# Timings for the slow parts of the simulator, run with `python benchmark.py > results.json`
+# Everything runs offline: horse pages are read from saved copies in data/fixtures, and the database
+# is a small synthetic one built from the columns of Exploratory/data/*_snip.csv in a temporary folder.
+# The results are written as JSON (with the commit they were run on) so runs can be compared between commits.
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'data', 'fixtures')
+SNIP_DIR = os.path.join(os.path.dirname(__file__), '..', 'Exploratory', 'data')
+FIELD_SIZES = [4, 8, 12, 16, 20]
+# Startup times (ms) in a new process that app workers should stay under, see bench_startup
+STARTUP_TARGETS = {'import_race_ms': 250, 'first_race_ms': 600, 'first_render_ms': 2500}
+# Run in a new process by bench_startup, with the synthetic data folder as its argument
+STARTUP_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+import race
+imported = time.perf_counter()
+race.HorseDB.PATH_DATA = sys.argv[1]
+race.Race(sims=50, use_cache=False)
+done = time.perf_counter()
+print(json.dumps({'import_race_ms': (imported - start)*1000, 'first_race_ms': (done - start)*1000,
+                  'heavy_modules': [name for name in ('pandas', 'requests', 'bs4', 'lxml') if name in sys.modules]}))
+'''
+RENDER_SCRIPT = '''
+import time, json
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+AppTest.from_file('run.py', default_timeout=60).run()
+print(json.dumps({'first_render_ms': (time.perf_counter() - start)*1000}))
+'''
+
+def time_call(func, *args, repeat=20):
+    '''Returns the fastest time (seconds) of calling func(*args) repeat times.'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def full_tree_results(html):
+    '''Extraction used before pages were parsed by scraper.HorseFetcher.get_results, kept for comparison.'''
+    doc = BeautifulSoup(html, "html.parser")
+    data = {'distance':[], 'finish_time':[]}
+    for row in doc.find_all('tbody')[1].find_all('tr'):
+        data['distance'].append(utils.convert_to_meters(row.find_all('td')[3].text))
+        data['finish_time'].append(utils.mins_to_secs(row.find_all('td')[9].text))
+    return data
+
+def bench_parse(fixture_dir=FIXTURE_DIR, repeat=20):
+    '''Returns the parse time (ms) of each saved horse page, before and after.'''
+    results = []
+    for path in sorted(glob.glob(os.path.join(fixture_dir, '*.html'))):
+        with open(path) as f:
+            html = f.read()
+        # Both parsers have to agree before their times mean anything
+        expected = full_tree_results(html)
+        times_df = HorseFetcher.read_results(html)
+        assert times_df.to_dict('list') == expected, path
+        before = time_call(full_tree_results, html, repeat=repeat)
+        after = time_call(HorseFetcher.read_results, html, repeat=repeat)
+        results.append({'page':os.path.basename(path), 'rows':len(times_df),
+                        'full_tree_ms':round(before*1000, 3), 'targeted_ms':round(after*1000, 3),
+                        'speedup':round(before/after, 1)})
+    return results
+
+def make_synthetic_data(path_data, races_per_distance=60, num_horses=48, field=12, seed=0):
+    """
+    Writes races.csv and runs.csv to path_data with every column of the snip csvs.
+    Each race copies a snip race (and each run a snip run), with a valid distance and new sectional
+    times from a pool of horses of differing speed, consistency, and endurance. The pool is small
+    enough that each horse runs every distance more than 10 times, so every distance has rating groups.
+    """
+    rng = np.random.default_rng(seed)
+    races_snip = pd.read_csv(os.path.join(SNIP_DIR, 'races_snip.csv'))
+    runs_snip = pd.read_csv(os.path.join(SNIP_DIR, 'runs_snip.csv'))
+    # Horses run at about the snip's meters per second
+    snip_mps = (races_snip.set_index('race_id')['distance'].reindex(runs_snip['race_id']).values
+                / runs_snip['finish_time'].values).mean()
+    speed = rng.normal(snip_mps, 0.4, num_horses)
+    consistency = rng.gamma(4, 0.08, num_horses)
+    endurance = rng.normal(0, 0.4, num_horses)
+    distances = np.repeat(Race.VALID_DISTANCES, races_per_distance)
+    races = races_snip.iloc[rng.integers(len(races_snip), size=len(distances))].reset_index(drop=True)
+    races['race_id'] = np.arange(len(distances))
+    races['distance'] = distances
+    runs = []
+    for race_id, distance in enumerate(distances):
+        # Sections are 400m, apart from a shorter first section
+        first = distance % 400 or 400
+        sections = np.array([first] + [400]*((distance - first)//400))
+        horse_ids = rng.choice(num_horses, field, replace=False)
+        run = runs_snip.iloc[rng.integers(len(runs_snip), size=field)].reset_index(drop=True)
+        run['race_id'] = race_id
+        run['horse_no'] = np.arange(1, field + 1)
+        run['horse_id'] = horse_ids
+        # Horses start slowly and tire by their endurance over the race
+        mps = (speed[horse_ids, None] + rng.normal(0, consistency[horse_ids, None], (field, len(sections)))
+               - endurance[horse_ids, None]*np.arange(len(sections))/len(sections))
+        mps[:, 0] -= 1.5
+        times = np.round(sections/mps, 2)
+        for section in range(6):
+            run[f'time{section + 1}'] = times[:, section] if section < len(sections) else np.nan
+        run['finish_time'] = times.sum(axis=1).round(2)
+        runs.append(run)
+    os.makedirs(path_data, exist_ok=True)
+    races.to_csv(os.path.join(path_data, 'races.csv'), index=False)
+    pd.concat(runs).to_csv(os.path.join(path_data, 'runs.csv'), index=False)
+    return
+
+def build_synthetic_db(path_data):
+    """Builds a synthetic database in path_data and makes it the one every HorseDB (and so every Track) uses."""
+    make_synthetic_data(path_data)
+    HorseDB.PATH_DATA = path_data
+    HorseDB().rebuild_db()
+    return
+
+def bench_db(repeat=20):
+    """
+    Returns the latency (ms) of building a Track with its rating tables and querying its data at each distance,
+    from the database with an empty query cache (cold), with a full one (warm), and from a snapshot.
+    """
+    results = []
+    db = HorseDB()
+    for distance in Race.VALID_DISTANCES:
+        params = {'distance':distance}
+        def cold(query):
+            HorseDB.CACHE.clear()
+            return query(params)
+        result = {'distance':distance}
+        for name, query in [('grouped', db.get_grouped_data), ('ungrouped', db.get_ungrouped_data)]:
+            result[f'{name}_cold_ms'] = round(time_call(cold, query, repeat=repeat)*1000, 3)
+            result[f'{name}_warm_ms'] = round(time_call(query, params, repeat=repeat)*1000, 3)
+        # Tracks only build their rating tables when they're first needed, so each build includes them
+        def build(use_snapshot=True, cold=False):
+            if cold:
+                HorseDB.CACHE.clear()
+            return Track(distance, use_snapshot).load_tables()
+        result['track_cold_ms'] = round(time_call(build, False, True, repeat=repeat)*1000, 3)
+        result['track_warm_ms'] = round(time_call(build, False, repeat=repeat)*1000, 3)
+        Track(distance, use_snapshot=False).save_snapshot()
+        result['track_snapshot_ms'] = round(time_call(build, repeat=repeat)*1000, 3)
+        results.append(result)
+    return results
+
+def bench_sim(sims=1000, field_sizes=FIELD_SIZES, repeat=3, seed=0):
+    """
+    Returns the throughput of get_race_odds (simulated races per second) and the time (ms) of one
+    simulate_race for each field size at each distance. Horses get the same random ratings every run.
+    """
+    results = []
+    rng = np.random.default_rng(seed)
+    for distance in Race.VALID_DISTANCES:
+        track = Track(distance)
+        for num_horses in field_sizes:
+            horses = [Horse(f'Horse {i + 1}', *rng.integers(1, 9, 3)) for i in range(num_horses)]
+            race = Race(horses, track, num_horses, sims=sims, seed=seed, get_odds=False, use_cache=False)
+            odds_time = time_call(race.get_race_odds, repeat=repeat)
+            np.random.seed(seed) # simulate_race draws from numpy's global generator
+            race_time = time_call(race.simulate_race, False, repeat=repeat*10)
+            results.append({'distance':distance, 'horses':num_horses, 'sims':sims,
+                            'odds_ms':round(odds_time*1000, 3), 'sims_per_s':round(sims/odds_time),
+                            'simulate_race_ms':round(race_time*1000, 3)})
+    return results
+
+def run_script(script, *args):
+    '''Runs a python script in a new process from the Run folder and returns the JSON it prints.'''
+    result = subprocess.run([sys.executable, '-c', script, *args], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(result.stdout.splitlines()[-1])
+
+def bench_startup(path_data, repeat=5):
+    """
+    Returns the median time (ms) a new process takes to import race, to finish its first random race
+    (from snapshots, as app workers start), and to draw the website's first page (if streamlit is installed),
+    each with its target from STARTUP_TARGETS. Also lists the slow to import modules loaded by the first race.
+    """
+    Race.export_snapshots() # Workers start from snapshots, so the first race shouldn't need the database
+    runs = [run_script(STARTUP_SCRIPT, path_data) for _ in range(repeat)]
+    results = {name: float(np.median([run[name] for run in runs])) for name in ('import_race_ms', 'first_race_ms')}
+    results['heavy_modules'] = runs[0]['heavy_modules']
+    try:
+        import streamlit
+    except ImportError:
+        results['first_render_ms'] = None
+    else:
+        results['first_render_ms'] = float(np.median([run_script(RENDER_SCRIPT)['first_render_ms'] for _ in range(repeat)]))
+    return {name: {'ms': None if results[name] is None else round(results[name], 1), 'target_ms': target,
+                   'met': None if results[name] is None else results[name] <= target}
+            for name, target in STARTUP_TARGETS.items()} | {'heavy_modules': results['heavy_modules']}
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError: # git isn't installed
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Times the simulator offline and writes the results as JSON.')
+    parser.add_argument('--groups', nargs='+', choices=['sim', 'db', 'parse', 'startup'],
+                        default=['sim', 'db', 'parse', 'startup'],
+                        help='benchmarks to run')
+    parser.add_argument('--sims', type=int, default=1000, help='simulations per get_race_odds call')
+    parser.add_argument('--repeat', type=int, default=20, help='calls timed for each database and parse result')
+    parser.add_argument('--output', default='-', help="file to write the results to ('-' is stdout)")
+    args = parser.parse_args(argv)
+    results = {'commit':get_commit(), 'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'machine':{'python':platform.python_version(), 'numpy':np.__version__, 'pandas':pd.__version__,
+                          'platform':platform.platform(), 'processor':platform.processor(), 'cpus':os.cpu_count(),
+                          'parser':'lxml' if scraper.lxml is not None else 'html.parser'}}
+    # Anything printed along the way goes to stderr so the output stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr), tempfile.TemporaryDirectory() as path_data:
+        if {'sim', 'db', 'startup'} & set(args.groups):
+            build_synthetic_db(path_data)
+        if 'db' in args.groups:
+            results['db'] = bench_db(args.repeat)
+        if 'sim' in args.groups:
+            results['sim'] = bench_sim(args.sims)
+        if 'parse' in args.groups:
+            results['parse'] = bench_parse(repeat=args.repeat)
+        if 'startup' in args.groups:
+            results['startup'] = bench_startup(path_data)
+    text = json.dumps(results, indent=1)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import numpy as np
+import metrics
+
+# Vectorized race engine used by Race.simulate_race
+# Horses do not interact with each other during a race, so each horse's run is an independent trajectory.
+# Positions, velocities, stdevs, and fatigue for every horse are kept in NumPy arrays and a whole block of
+# seconds is drawn for all running horses in a single call. Within a block, a horse's parameters only change
+# when it crosses a quarter of the track or enters the last 400 meters, so each loop advances every horse
+# to its next such boundary instead of advancing one second at a time.
+# run_exact skips the seconds altogether and draws the time each horse takes to reach its next boundary.
+
+MAX_BLOCK = 64 # Most seconds of steps drawn at once for each running horse
+MIN_SPEED = 1 # Horses are assumed to always move forward at least this fast (meters per second)
+MAX_PASSES = 64 # Most boundary to boundary passes run_exact makes before giving up (a race only has a handful of boundaries)
+VERSION = 2 # Saved results (see results_cache.py) are only reused by the same version, so bump it when results change
+
+def get_boundaries(distance):
+    '''
+    Returns the length of a quarter of the race and the position where
+    the last 400 meters (when fatigue factors in) start.
+    '''
+    quarter = distance/4
+    return quarter, distance - 400
+
+@metrics.timed('engine')
+def run(velocity, stdev, fatigue, distance, rng=None):
+    '''
+    Simulates horses running a race of the given distance.
+    velocity, stdev, and fatigue are arrays (any shape) of each horse's parameters.
+    Steps are drawn from rng (a numpy Generator), or from np.random's global state if it isn't given.
+    Returns two arrays with the same shape as velocity: the second each horse
+    finished in, and how far each horse had travelled at that second.
+    '''
+    shape = np.shape(velocity)
+    velocity = np.asarray(velocity, dtype=float).ravel()
+    stdev = np.array(stdev, dtype=float).ravel() # Copies, since these are scaled every quarter
+    fatigue = np.array(fatigue, dtype=float).ravel()
+    n = len(velocity)
+    normal = np.random.standard_normal if rng is None else rng.standard_normal
+    quarter, fatigue_start = get_boundaries(distance)
+    position = np.zeros(n)
+    time = np.zeros(n, dtype=int)
+    # Fatigue factors in once a horse's position is within the last 400 meters
+    tired = np.full(n, 0 >= fatigue_start)
+    next_quarter = np.full(n, quarter)
+    # Only the horses still running are drawn for, so finished horses cost nothing
+    running = np.arange(n)
+    while len(running):
+        m = len(running)
+        horses = np.arange(m)
+        start = position[running]
+        running_tired = tired[running]
+        running_quarter = next_quarter[running]
+        # Each horse runs until the next point where its behavior changes
+        boundary = np.minimum(running_quarter, np.where(running_tired, distance, fatigue_start))
+        speed = velocity[running] - fatigue[running]*running_tired
+        # Draw enough seconds for the slowest horse to reach its boundary
+        seconds = ((boundary - start)/np.maximum(speed, 1)).max()
+        block = min(int(seconds) + 2, MAX_BLOCK) if seconds > 0 else MAX_BLOCK
+        # Steps are built in place, since the blocks are the largest arrays in the race
+        path = normal((block, m))
+        path *= stdev[running]
+        path += speed
+        path[0] += start
+        np.cumsum(path, axis=0, out=path)
+        # First second where each horse reached its boundary (or the end of the block)
+        crossed = path >= boundary
+        idx = crossed.argmax(axis=0)
+        hit = crossed[idx, horses]
+        idx[~hit] = block - 1
+        # Steps after the boundary were drawn with the old parameters, so they are thrown away
+        end = path[idx, horses]
+        position[running] = end
+        time[running] += idx + 1
+        tired[running] = running_tired | (hit & (end >= fatigue_start))
+        # After each quarter of the race, increase stdev and fatigue
+        new_quarter = running[hit & (end >= running_quarter)]
+        stdev[new_quarter] *= 2
+        fatigue[new_quarter] *= 1.1
+        next_quarter[new_quarter] += quarter
+        running = running[~hit | (end < distance)]
+    return time.reshape(shape), position.reshape(shape)
+
+@metrics.timed('engine')
+def run_exact(velocity, stdev, fatigue, distance, rng=None):
+    '''
+    Simulates horses running a race of the given distance without one second ticks.
+    A horse's steps are normally distributed, so the time it takes to cover a stretch of track
+    with the same parameters is inverse Gaussian (Wald) distributed. Each horse's time to its
+    next boundary is drawn directly, which takes a handful of draws per horse for the whole race
+    and gives finish times in fractions of a second.
+    Horses with a stdev of 0 don't vary, so they take exactly remaining/speed seconds to each boundary.
+    Returns the same (finish_time, finish_position) arrays as run, with float finish times.
+    Raises ValueError if the horses haven't finished after MAX_PASSES boundaries (like with nan parameters).
+    '''
+    if rng is None:
+        rng = np.random
+    shape = np.shape(velocity)
+    velocity = np.asarray(velocity, dtype=float).ravel()
+    stdev = np.array(stdev, dtype=float).ravel() # Copies, since these are scaled every quarter
+    fatigue = np.array(fatigue, dtype=float).ravel()
+    n = len(velocity)
+    quarter, fatigue_start = get_boundaries(distance)
+    position = np.zeros(n)
+    time = np.zeros(n)
+    tired = np.full(n, 0 >= fatigue_start)
+    next_quarter = np.full(n, quarter)
+    for _ in range(MAX_PASSES):
+        boundary = np.minimum(next_quarter, np.where(tired, distance, fatigue_start))
+        speed = np.maximum(velocity - fatigue*tired, MIN_SPEED)
+        # Horses that overshot this boundary in their last second start past it
+        remaining = boundary - position
+        ahead = remaining > 0
+        remaining = np.where(ahead, remaining, 1)
+        # The Wald shape is infinite (and its draws nan) without any spread, so those horses' times are fixed
+        steady = stdev <= 0
+        draws = rng.wald(remaining/speed, (remaining/np.where(steady, 1, stdev))**2)
+        time += np.where(ahead, np.where(steady, remaining/speed, draws), 0)
+        finishing = boundary >= distance
+        if finishing.all():
+            return time.reshape(shape), np.full(shape, float(distance))
+        # As in run, a horse keeps its old parameters until the end of the second it crossed the boundary in
+        rest = np.where(finishing, 0, np.ceil(time) - time)
+        # Horses that started past the boundary aren't pulled back to it
+        position = np.where(finishing, distance,
+                            np.maximum(position, boundary) + speed*rest + stdev*np.sqrt(rest)*rng.standard_normal(n))
+        time += rest
+        tired |= ~finishing & (position >= fatigue_start)
+        # After each quarter of the race, increase stdev and fatigue
+        new_quarter = ~finishing & (position >= next_quarter)
+        stdev[new_quarter] *= 2
+        fatigue[new_quarter] *= 1.1
+        next_quarter[new_quarter] += quarter
+    raise ValueError(f'Horses did not finish a {distance} meter race after {MAX_PASSES} boundaries')
+
+def stream(velocity, stdev, fatigue, distance, rng=None):
+    '''
+    Same race as run, but one second at a time so it can be watched. Yields (second, positions) after every
+    second, where positions is a float32 array of how far each horse (a 1d array of parameters) has run,
+    stopping at the finish line. Only the current positions are kept, so memory doesn't grow with the race.
+    Returns each horse's finish second and how far they had travelled at that second, as run does.
+    '''
+    velocity = np.asarray(velocity, dtype=float)
+    stdev = np.array(stdev, dtype=float) # Copies, since these are scaled every quarter
+    fatigue = np.array(fatigue, dtype=float)
+    n = len(velocity)
+    normal = np.random.standard_normal if rng is None else rng.standard_normal
+    quarter, fatigue_start = get_boundaries(distance)
+    position = np.zeros(n)
+    time = np.zeros(n, dtype=int)
+    tired = np.full(n, 0 >= fatigue_start)
+    next_quarter = np.full(n, quarter)
+    running = np.ones(n, dtype=bool)
+    second = 0
+    while running.any():
+        second += 1
+        # A horse keeps its parameters for the whole second it crosses a boundary in, as in run
+        step = stdev*normal(n) + velocity - fatigue*tired
+        position[running] += step[running]
+        time[running] = second
+        tired |= running & (position >= fatigue_start)
+        new_quarter = running & (position >= next_quarter)
+        stdev[new_quarter] *= 2
+        fatigue[new_quarter] *= 1.1
+        next_quarter[new_quarter] += quarter
+        running &= position < distance
+        yield second, np.minimum(position, distance).astype(np.float32)
+    return time, position
+
+def rank(finish_time, finish_position):
+    '''
+    Returns the indices of the horses in finishing order. Horses that finish in
+    the same second are ordered by distance covered, furthest first, as the original
+    race loop's comment says (its code sorted them nearest first). Horses with the same
+    time and distance keep their order in the field.
+    '''
+    return np.lexsort((-finish_position, finish_time), axis=-1)
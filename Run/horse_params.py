@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import contextlib
+import logging
+import metrics
+
+# Real horses' fitted parameters (the per-distance mps means and stds, stdev stats, and fatigue slope that
+# Horse.summarize_races boils their past races down to) are saved in a SQLite database, keyed by the horse's
+# name and when their race data was fetched. A horse's races are only summarized once per fetch, and races
+# between real horses can be priced from the saved parameters without reading their data or a network connection.
+#
+# Parameters fit within MAX_AGE seconds are used as they are. Older ones are refit once the horse's page is
+# fetched again, and are still used (with a warning) if it can't be. When offline (HORSE_OFFLINE=1 in the
+# environment, or offline=True), nothing is fetched and the newest saved parameters are always used.
+
+PARAMS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'horse_params.db')
+MAX_AGE = 24*60*60 # Seconds before a horse's parameters are refit from newer data (the same as scraper.CACHE_TTL)
+VERSION = 1 # Parameters are only reused by the same version, so bump it when Horse.summarize_races changes
+OFFLINE = os.environ.get('HORSE_OFFLINE', '') not in ('', '0')
+
+log = logging.getLogger(__name__)
+
+class ParamStore:
+    def __init__(self, path=PARAMS_PATH, max_age=MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.ready = False
+        return
+
+    def connect(self):
+        """Returns a new connection, creating the database the first time (as ResultsCache.connect does)."""
+        if not self.ready:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        if not self.ready:
+            conn.execute("PRAGMA journal_mode = WAL;")
+            # The primary key's index finds a horse's newest parameters without scanning the table
+            conn.execute("""CREATE TABLE IF NOT EXISTS tHorseParams
+                            (name TEXT, version INTEGER, fetched REAL, races INTEGER, params TEXT,
+                             PRIMARY KEY (name, version, fetched));""")
+            self.ready = True
+        return conn
+
+    def get(self, name):
+        """Returns the newest saved (fetched time, parameters) of a horse, or None if they were never fit."""
+        conn = self.connect()
+        try:
+            row = conn.execute("""SELECT fetched, params FROM tHorseParams WHERE name = ? AND version = ?
+                                  ORDER BY fetched DESC LIMIT 1;""", (name, VERSION)).fetchone()
+        finally:
+            conn.close()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def put(self, name, fetched, params, races):
+        """
+        Saves a horse's parameters, fit from `races` races fetched at `fetched` (seconds since the epoch).
+        Older fits of the horse are deleted, since only the newest is ever used.
+        """
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE;") # The old fits are replaced in one go, so the horse always has one
+            conn.execute("DELETE FROM tHorseParams WHERE name = ? AND version = ? AND fetched < ?;", (name, VERSION, fetched))
+            conn.execute("INSERT OR REPLACE INTO tHorseParams VALUES (?, ?, ?, ?, ?);",
+                         (name, VERSION, fetched, races, json.dumps(params)))
+            conn.execute("COMMIT;")
+        finally:
+            conn.close()
+        return
+
+    @staticmethod
+    def fit(times_df):
+        """Returns the parameters of a horse with the given race data (see Horse.summarize_races), or None if it's empty."""
+        from race import Horse
+        if len(times_df) == 0:
+            return None
+        horse = Horse.__new__(Horse)
+        horse.summarize_races(times_df['distance'].to_numpy(dtype=float), times_df['finish_time'].to_numpy(dtype=float))
+        return horse.get_fit()
+
+    def get_fits(self, names, offline=None, fetcher=None):
+        """
+        Returns a dictionary of each horse's parameters (None for horses without data), fetching and fitting
+        only the horses whose saved parameters are missing or older than max_age. All of those are fetched at once.
+        """
+        if offline is None:
+            offline = OFFLINE
+        fits, stale = {}, []
+        with metrics.phase('horse_params'):
+            for name in names:
+                saved = self.get(name)
+                fits[name] = None if saved is None else saved[1]
+                if not offline and (saved is None or time.time() - saved[0] >= self.max_age):
+                    stale.append(name)
+        metrics.count('horse_params_hits', len(fits) - len(stale))
+        if not stale:
+            return fits
+        if fetcher is None:
+            from scraper import FETCHER as fetcher # Only imported when horses have to be fetched
+        all_times = fetcher.get_all_times(stale)
+        with metrics.phase('fit'):
+            for name in stale:
+                params = self.fit(all_times[name])
+                if params is None:
+                    if fits[name] is not None: # The page couldn't be fetched, so the old parameters are better than none
+                        log.warning('Using saved parameters for %s', name, extra={'horse':name})
+                    continue
+                # Fit data is timed by when the page was fetched, which is when its cached copy was written
+                path = fetcher.get_cache_path(name)
+                fetched = os.path.getmtime(path) if os.path.exists(path) else time.time()
+                self.put(name, fetched, params, len(all_times[name]))
+                fits[name] = params
+        metrics.count('horse_params_fits', len(stale))
+        return fits
+
+    def info(self):
+        """Returns the number of horses with saved parameters and the number of saved fits."""
+        conn = self.connect()
+        try:
+            horses, fits = conn.execute("SELECT COUNT(DISTINCT name), COUNT(*) FROM tHorseParams WHERE version = ?;",
+                                        (VERSION,)).fetchone()
+        finally:
+            conn.close()
+        return {'horses': horses, 'fits': fits}
+
+# Shared by every session, like scraper.FETCHER
+PARAMS = ParamStore()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fits real horses' parameters ahead of time so they can be priced offline.")
+    parser.add_argument('names', nargs='*', help="horses to fetch and fit (or read from --file)")
+    parser.add_argument('--file', default=None, help="file with one horse's name per line")
+    parser.add_argument('--refit', action='store_true', help='fetch fresh pages and fit every horse, even ones fit or fetched within the last day')
+    args = parser.parse_args(argv)
+    names = list(args.names)
+    if args.file:
+        with open(args.file) as f:
+            names += [line.strip() for line in f if line.strip()]
+    out = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.refit: # Refitting from day-old cached pages wouldn't change anything, so every page is fetched again
+            from scraper import HorseFetcher
+            store, fetcher = ParamStore(PARAMS.path, max_age=0), HorseFetcher(ttl=0)
+        else:
+            store, fetcher = PARAMS, None
+        fits = store.get_fits(names, offline=False, fetcher=fetcher)
+        for name, params in fits.items():
+            out.write(json.dumps({'name': name, 'fit': params is not None}) + '\n')
+        out.write(json.dumps(PARAMS.info()) + '\n')
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+# Timings and counts of the simulator's phases (loading tracks, querying the database, fetching horses,
+# finding parameters, simulating, and rounding odds), with a breakdown for each request
+# Nothing is measured unless metrics are enabled (metrics.enable(), or HORSE_METRICS=1 in the environment) or a
+# request is being timed, so the hooks in the hot paths only check a flag and a context variable when they are off
+# A timed request's phases are only added to the process' counters and histograms when metrics are enabled
+#
+#     metrics.enable()
+#     with metrics.request() as timings:
+#         Race(horses, track, 8, sims=1000)
+#     timings            # {'track': 0.02, 'params': 0.0001, 'simulate': 0.41, 'engine': 0.33, 'odds': 0.0001}
+#     metrics.to_prometheus()
+#
+# Phases can be inside other phases (engine is part of simulate), so a request's phases don't add up to its total
+
+ENABLED = os.environ.get('HORSE_METRICS', '') not in ('', '0')
+PREFIX = 'horse_racing'
+# Upper bounds (seconds) of the histogram buckets each phase's times are counted in
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+log = logging.getLogger(__name__)
+_REQUEST = contextvars.ContextVar('request', default=None) # Phase times of the current request, if one is being timed
+_OFF = nullcontext()
+
+class Histogram:
+    # Counts of observations at or below each bucket's upper bound, as Prometheus histograms are exported
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1) # The last bucket holds everything above the largest bound
+        self.sum = 0
+        self.count = 0
+        return
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        return
+
+    def cumulative(self):
+        """Returns (upper bound, number of observations at or below it) for every bucket, ending with +Inf."""
+        total, counts = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+class Registry:
+    # Every counter and phase histogram in the process. Streamlit sessions run in separate threads, so updates are locked
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        return
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        return
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            if phase not in self.histograms:
+                self.histograms[phase] = Histogram()
+            self.histograms[phase].observe(seconds)
+        return
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+        return
+
+    def summary(self):
+        """Returns the counters and each phase's number of calls, total seconds, and mean milliseconds."""
+        with self.lock:
+            phases = {phase: {'calls': hist.count, 'seconds': round(hist.sum, 6), 'mean_ms': round(hist.sum/hist.count*1000, 3)}
+                      for phase, hist in self.histograms.items()}
+            return {'counters': dict(self.counters), 'phases': phases}
+
+    def to_prometheus(self, prefix=PREFIX):
+        """Returns the counters and phase histograms in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines += [f'# TYPE {prefix}_{name}_total counter', f'{prefix}_{name}_total {value}']
+            if self.histograms:
+                name = f'{prefix}_phase_seconds'
+                lines += [f'# HELP {name} Time spent in each phase of the simulator', f'# TYPE {name} histogram']
+            for phase, hist in sorted(self.histograms.items()):
+                for bound, count in hist.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{{phase="{phase}",le="{le}"}} {count}')
+                lines.append(f'{name}_sum{{phase="{phase}"}} {hist.sum!r}')
+                lines.append(f'{name}_count{{phase="{phase}"}} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def enable():
+    global ENABLED
+    ENABLED = True
+    return
+
+def disable():
+    global ENABLED
+    ENABLED = False
+    return
+
+def count(name, amount=1):
+    '''Adds amount to a counter, if metrics are enabled.'''
+    if ENABLED:
+        REGISTRY.count(name, amount)
+    return
+
+@contextmanager
+def _timed_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if ENABLED:
+            REGISTRY.observe(name, seconds)
+        timings = _REQUEST.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + seconds
+        log.debug('phase', extra={'phase': name, 'seconds': seconds})
+
+def phase(name):
+    '''Returns a context manager that times its block as the named phase (or does nothing if metrics are disabled and no request is timed).'''
+    return _timed_phase(name) if ENABLED or _REQUEST.get() is not None else _OFF
+
+def timed(name):
+    '''Decorates a function so every call is timed as the named phase.'''
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED and _REQUEST.get() is None:
+                return func(*args, **kwargs)
+            with _timed_phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def request(enabled=True):
+    '''
+    Collects the total seconds of each phase run inside the with block (in this thread) into the dictionary it yields,
+    whether or not metrics are enabled. With enabled=False nothing extra is timed, and the dictionary is left empty.
+    '''
+    timings = {}
+    if not enabled:
+        yield timings
+        return
+    token = _REQUEST.set(timings)
+    start = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        timings['total'] = time.perf_counter() - start
+        _REQUEST.reset(token)
+
+def summary():
+    return REGISTRY.summary()
+
+def to_prometheus():
+    return REGISTRY.to_prometheus()
+
+def write_prometheus(path):
+    '''Writes the metrics to a file in the Prometheus text format (e.g. for node_exporter's textfile collector).'''
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(to_prometheus())
+    os.replace(tmp_path, path)
+    return
+
+class JsonFormatter(logging.Formatter):
+    # Formats each log record as a line of JSON, including the fields passed to the logger in extra
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        entry.update({key: value for key, value in vars(record).items() if key not in self.RESERVED})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logging(level='INFO', json_lines=False):
+    '''Shows the simulator's log messages on stderr, as text or as JSON lines.'''
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter('%(levelname)s %(name)s: %(message)s'))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+    return
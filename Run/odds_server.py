@@ -0,0 +1,340 @@
+import json
+import time
+import asyncio
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+import numpy as np
+import utils
+import batch
+import metrics
+from race import Race, get_horse_names, get_track
+
+# A JSON odds service, run with `python odds_server.py serve --port 8600` (from the Run directory)
+# Requests take the same inputs as the website (race type, distance, horses, sims), and races are simulated on a
+# bounded process pool so requests don't block each other. Identical requests that come in while one is being
+# simulated share its result, and once max_queue simulations are waiting, new ones get a 429 until the pool catches up.
+#
+#     POST /odds   {"race_type": "create", "distance": 1200, "horses": {"Horse 1": [5, 4, 6], ...}, "sims": 1000}
+#                  race_type "real" takes a list of names (and distances like 6f or 1mi), "random" takes num_horses
+#                  Returns {"race": ..., "odds": {name: [numer, denom]}, "sims": ...}, where race holds the horses
+#                  (with any random ones filled in) in batch.py's format
+#     POST /race   {"race": <race from /odds>} simulates a single race, returning {name: [seconds, place]}
+#     GET /health  queue depth and pool size
+#     GET /metrics timings in the Prometheus text format (see metrics.py)
+
+WORKERS = 2 # Processes simulating races
+MAX_QUEUE = 8 # Most simulations running or waiting before requests are turned away
+MAX_BODY = 64*1024 # Largest request body (bytes)
+RETRY_AFTER = 1 # Seconds busy clients are told to wait
+
+log = logging.getLogger(__name__)
+
+class RequestError(ValueError):
+    # A request that can't be priced, sent back to the client as a 400
+    pass
+
+def read_race(body):
+    """
+    Checks an /odds request and returns its race in batch.py's format, with any random distance filled in.
+    Horses are 'random' for random races. Raises RequestError for anything the website wouldn't allow.
+    """
+    if not isinstance(body, dict):
+        raise RequestError('Request must be a JSON object')
+    race_type = body.get('race_type', 'random')
+    if race_type not in ('real', 'create', 'random'):
+        raise RequestError("race_type must be 'real', 'create', or 'random'")
+    distance = body.get('distance', 'random')
+    if race_type != 'real' and distance == 'random':
+        distance = Race.VALID_DISTANCES[np.random.randint(len(Race.VALID_DISTANCES))]
+    try: # Real horses can race any distance, written like the website's text box (6f, 1mi, 1200m)
+        distance = utils.parse_distance(str(distance)) if race_type == 'real' else float(distance)
+    except (TypeError, ValueError, IndexError, UnboundLocalError): # What the distance converters raise for text they can't read
+        raise RequestError(f'Could not read distance: {distance!r}')
+    if race_type != 'real' and distance not in Race.VALID_DISTANCES:
+        raise RequestError(f'distance must be one of {Race.VALID_DISTANCES} or random')
+    race = {'distance': int(distance) if distance.is_integer() else distance}
+    horses = body.get('horses')
+    if race_type == 'random':
+        num_horses = body.get('num_horses', 'random')
+        if num_horses != 'random' and not (isinstance(num_horses, int) and 4 <= num_horses <= 20):
+            raise RequestError('num_horses must be 4 to 20 or random')
+        race['horses'] = 'random'
+        race['num_horses'] = num_horses
+        return race
+    if race_type == 'real':
+        names = list(horses) if isinstance(horses, (list, dict)) else []
+        race['horses'] = [{'name': str(name)} for name in names]
+    else:
+        if not isinstance(horses, dict):
+            raise RequestError('Created horses must be an object of name: [speed, consistency, endurance]')
+        race['horses'] = []
+        for name, ratings in horses.items():
+            if not (isinstance(ratings, list) and len(ratings) == 3 and all(isinstance(r, int) and 1 <= r <= 8 for r in ratings)):
+                raise RequestError(f'{name} needs three ratings from 1 to 8')
+            race['horses'].append(dict(zip(('name', 'speed', 'consistency', 'endurance'), [str(name)] + ratings)))
+    if not 4 <= len(race['horses']) <= 20:
+        raise RequestError('A race has 4 to 20 horses')
+    if len({horse['name'] for horse in race['horses']}) < len(race['horses']):
+        raise RequestError('Every horse needs a different name')
+    return race
+
+def check_race(race):
+    '''Raises RequestError unless race is a race sent back by /odds (see describe).'''
+    if not (isinstance(race, dict) and isinstance(race.get('distance'), (int, float)) and isinstance(race.get('horses'), list)
+            and 4 <= len(race['horses']) <= 20):
+        raise RequestError('race must be a race returned by /odds')
+    for horse in race['horses']:
+        ratings = [horse.get(rating) for rating in ('speed', 'consistency', 'endurance')] if isinstance(horse, dict) else None
+        if ratings is None or 'name' not in horse or not (ratings == [None]*3 or all(isinstance(r, int) and 1 <= r <= 8 for r in ratings)):
+            raise RequestError('race must be a race returned by /odds')
+    return
+
+def read_options(body):
+    '''Returns the sims, seed, exact, and markets settings of an /odds request.'''
+    sims = body.get('sims', 50)
+    if sims != 'auto' and not (isinstance(sims, int) and 1 <= sims <= Race.MAX_SIMS):
+        raise RequestError(f"sims must be 1 to {Race.MAX_SIMS} or 'auto'")
+    seed = body.get('seed')
+    if seed is not None and not (isinstance(seed, int) and seed >= 0):
+        raise RequestError('seed must be a non-negative integer')
+    return {'sims': sims, 'seed': seed, 'exact': bool(body.get('exact', False)), 'markets': bool(body.get('markets', False))}
+
+def make_race(race, **kwargs):
+    '''Creates the Race for a race dictionary (see read_race), using real horses' saved parameters.'''
+    track = get_track(race['distance'])
+    if race['horses'] == 'random':
+        return Race('random', track, race.get('num_horses', 'random'), **kwargs)
+    real_names = [horse['name'] for horse in race['horses'] if not all(rating in horse for rating in batch.RATINGS)]
+    fits = {}
+    if real_names:
+        from horse_params import PARAMS
+        fits = PARAMS.get_fits(real_names)
+    return Race(batch.create_horses(race, fits), track, len(race['horses']), **kwargs)
+
+def describe(race):
+    '''Returns a Race's distance and horses in batch.py's format, so the same race can be sent to /race.'''
+    horses = [{'name': horse.name} if horse.real else
+              {'name': horse.name, 'speed': int(horse.top_speed), 'consistency': int(horse.consistency), 'endurance': int(horse.endurance)}
+              for horse in race.horses]
+    return {'distance': race.track.distance, 'horses': horses}
+
+def price_race(race, sims, seed, exact, markets):
+    '''Simulates a race's odds in a worker process.'''
+    race = make_race(race, sims=sims, seed=seed, exact=exact)
+    result = {'race': describe(race), 'odds': race.odds, 'sims': race.sims}
+    if sims == 'auto':
+        result['converged'] = race.adaptive['converged']
+    if markets:
+        result['markets'] = batch.get_markets(race)
+    return result
+
+def run_race(race, exact):
+    '''Simulates a single race in a worker process, returning each horse's finish time and place.'''
+    return make_race(race, exact=exact, get_odds=False).simulate_race()
+
+class OddsServer:
+    def __init__(self, workers=WORKERS, max_queue=MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        # Forked workers would all start with the same random state, so each is reseeded for random races
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=np.random.seed)
+        self.pending = 0 # Simulations submitted to the pool that haven't finished
+        self.in_flight = {} # Pending simulations that identical requests can share, by request
+        return
+
+    async def submit(self, func, *args, key=None):
+        """
+        Runs func(*args) on the process pool and returns its result. Requests with the same key
+        share the simulation already running for it. Raises OverflowError if the queue is full.
+        """
+        if key is not None and key in self.in_flight:
+            metrics.count('server_coalesced')
+            return await asyncio.shield(self.in_flight[key])
+        if self.pending >= self.max_queue:
+            metrics.count('server_rejected')
+            raise OverflowError('Too many simulations waiting, try again shortly')
+        future = asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+        self.pending += 1
+        if key is not None:
+            self.in_flight[key] = future
+        # The queue is freed when the simulation finishes, even if every client waiting for it has gone
+        future.add_done_callback(lambda _: self.finish(key))
+        return await asyncio.shield(future)
+
+    def finish(self, key):
+        self.pending -= 1
+        if key is not None:
+            self.in_flight.pop(key, None)
+        return
+
+    async def route(self, method, path, body):
+        """Returns the status, JSON-ready (or text) response, and content type for a request."""
+        if method == 'GET' and path == '/health':
+            return HTTPStatus.OK, {'status': 'ok', 'pending': self.pending, 'max_queue': self.max_queue, 'workers': self.workers}, None
+        if method == 'GET' and path == '/metrics':
+            return HTTPStatus.OK, metrics.to_prometheus(), 'text/plain; version=0.0.4'
+        if method != 'POST' or path not in ('/odds', '/race'):
+            return HTTPStatus.NOT_FOUND, {'error': f'No route for {method} {path}'}, None
+        try:
+            body = json.loads(body or b'{}')
+            if path == '/odds':
+                race, options = read_race(body), read_options(body)
+                # Races with random horses or distance and no seed are new races every time, so they aren't shared
+                random = race['horses'] == 'random' or body.get('distance', 'random') == 'random'
+                key = None if random and options['seed'] is None else json.dumps([race, options], sort_keys=True)
+                with metrics.phase('server_odds'):
+                    result = await self.submit(price_race, race, options['sims'], options['seed'], options['exact'],
+                                               options['markets'], key=key)
+            else:
+                race = body.get('race')
+                check_race(race)
+                with metrics.phase('server_race'):
+                    result = await self.submit(run_race, race, bool(body.get('exact', False)))
+        except json.JSONDecodeError:
+            return HTTPStatus.BAD_REQUEST, {'error': 'Request body must be JSON'}, None
+        except OverflowError as error:
+            return HTTPStatus.TOO_MANY_REQUESTS, {'error': str(error)}, None
+        except ValueError as error: # Bad requests, and real horses without any data
+            return HTTPStatus.BAD_REQUEST, {'error': str(error)}, None
+        except Exception as error:
+            log.exception('Request failed', extra={'path': path})
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'{type(error).__name__}: {error}'}, None
+        return HTTPStatus.OK, result, None
+
+    async def handle(self, reader, writer):
+        """Serves the requests of one connection, keeping it open between requests unless the client closes it."""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError: # The client closed the connection
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                method, path, version = lines[0].split(' ', 2)
+                headers = {name.strip().lower(): value.strip() for name, value in
+                           (line.split(':', 1) for line in lines[1:] if ':' in line)}
+                length = int(headers.get('content-length', 0))
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                if length > MAX_BODY:
+                    status, result, content_type = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': 'Request body is too large'}, None
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, result, content_type = await self.route(method, path.split('?')[0], body)
+                metrics.count(f'server_responses_{status.value}')
+                payload = (result if isinstance(result, str) else json.dumps(result)).encode()
+                response = [f'HTTP/1.1 {status.value} {status.phrase}', f'Content-Type: {content_type or "application/json"}',
+                            f'Content-Length: {len(payload)}', f'Connection: {"keep-alive" if keep_alive else "close"}']
+                if status == HTTPStatus.TOO_MANY_REQUESTS:
+                    response.append(f'Retry-After: {RETRY_AFTER}')
+                writer.write(('\r\n'.join(response) + '\r\n\r\n').encode() + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError): # Dropped connections and malformed requests
+            pass
+        finally:
+            writer.close()
+        return
+
+    async def serve(self, host='127.0.0.1', port=8600):
+        server = await asyncio.start_server(self.handle, host, port)
+        log.info('Serving odds on http://%s:%d', host, port, extra={'host': host, 'port': port})
+        async with server:
+            await server.serve_forever()
+
+class RemoteRace:
+    # Stands in for a Race on the website when the odds come from the service (run.py with ODDS_SERVICE_URL set)
+    # The odds are simulated when it's created, and simulate_race has the service run the same race
+    def __init__(self, url, body):
+        self.url = url.rstrip('/')
+        self.exact = bool(body.get('exact', False))
+        response = self.request('/odds', body)
+        self.race = response['race']
+        self.odds = {name: tuple(odds) for name, odds in response['odds'].items()}
+        self.sims = response['sims']
+        self.adaptive = {'converged': response.get('converged')}
+        return
+
+    def request(self, path, body):
+        """Returns the service's response, raising ValueError with a message for the website if it failed."""
+        status, response = post(self.url + path, body)
+        if status == HTTPStatus.TOO_MANY_REQUESTS:
+            raise ValueError('The odds service is busy, try again in a moment')
+        if status != HTTPStatus.OK:
+            raise ValueError(response.get('error', f'The odds service returned {status}'))
+        return response
+
+    def simulate_race(self):
+        return {name: tuple(result) for name, result in self.request('/race', {'race': self.race, 'exact': self.exact}).items()}
+
+def post(url, body, timeout=120):
+    '''Sends a JSON request to the odds service, returning the status and decoded response.'''
+    request = Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except HTTPError as error:
+        return error.code, json.loads(error.read() or b'{}')
+
+def load_test(url, total=200, concurrency=20, sims=1000, distinct=10):
+    '''
+    Sends total /odds requests, concurrency at a time, spread over distinct different races (so some
+    are coalesced). Returns the count of each status and the latency percentiles (ms) of the successful ones.
+    '''
+    names = get_horse_names()
+    rng = np.random.default_rng(0)
+    bodies = [{'race_type': 'create', 'distance': int(rng.choice(Race.VALID_DISTANCES)), 'sims': sims, 'seed': i,
+               'horses': {name: [int(r) for r in rng.integers(1, 9, 3)] for name in rng.choice(names, 8, replace=False)}}
+              for i in range(distinct)]
+    def send(i):
+        start = time.perf_counter()
+        status, _ = post(url.rstrip('/') + '/odds', bodies[i % distinct])
+        return status, time.perf_counter() - start
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(total)))
+    elapsed = time.perf_counter() - start
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = np.array([seconds for status, seconds in results if status == 200])*1000
+    percentiles = {f'p{p}': round(float(np.percentile(latencies, p)), 1) for p in (50, 90, 99)} if len(latencies) else {}
+    return {'requests': total, 'concurrency': concurrency, 'seconds': round(elapsed, 2),
+            'requests_per_s': round(total/elapsed, 1), 'statuses': statuses, 'latency_ms': percentiles}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='JSON odds service.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='run the service')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8600)
+    serve.add_argument('--workers', type=int, default=WORKERS, help='processes simulating races')
+    serve.add_argument('--max-queue', type=int, default=MAX_QUEUE, help='simulations running or waiting before returning 429')
+    test = commands.add_parser('load-test', help='send many /odds requests to a running service')
+    test.add_argument('--url', default='http://127.0.0.1:8600')
+    test.add_argument('--requests', type=int, default=200)
+    test.add_argument('--concurrency', type=int, default=20)
+    test.add_argument('--sims', type=int, default=1000)
+    test.add_argument('--distinct', type=int, default=10, help='different races the requests are spread over')
+    args = parser.parse_args(argv)
+    if args.command == 'load-test':
+        print(json.dumps(load_test(args.url, args.requests, args.concurrency, args.sims, args.distinct)))
+        return
+    metrics.setup_logging()
+    metrics.enable()
+    server = OddsServer(args.workers, args.max_queue)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.pool.shutdown(cancel_futures=True)
+    return
+
+if __name__ == '__main__':
+    main()
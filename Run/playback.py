@@ -0,0 +1,76 @@
+import json
+import struct
+import numpy as np
+
+# Helpers for watching races streamed by Race.stream_race (engine.stream)
+# Snapshots are (second, positions) pairs, and can be thinned out or saved to a compact binary log to be replayed.
+#
+# A log starts with MAGIC, the length of a JSON header (uint32), and the header itself (the horses' names and
+# the distance). Each snapshot after it is its second (uint16) and every horse's position in tenths of a
+# meter (uint16), so a 20 horse race takes 42 bytes a second.
+
+MAGIC = b'HRSLOG1\n'
+SCALE = 10 # Positions are saved in tenths of a meter
+MAX_DISTANCE = np.iinfo(np.uint16).max/SCALE # Longest race a log can hold (6553.5 meters)
+
+def downsample(snapshots, every=1):
+    '''
+    Yields every `every`th snapshot, and always the last one so the finish is never skipped.
+    The generator's return value (the race's results, for engine.stream) is passed on.
+    '''
+    snapshots = iter(snapshots)
+    last = None
+    count = 0
+    while True:
+        try:
+            snapshot = next(snapshots)
+        except StopIteration as stop:
+            if last is not None:
+                yield last
+            return stop.value
+        if count % every == 0:
+            last = None
+            yield snapshot
+        else:
+            last = snapshot
+        count += 1
+
+def write_log(path, names, distance, snapshots):
+    '''
+    Writes snapshots to a binary log as they come, and yields them on so the race can be watched while it's saved.
+    The generator's return value (the race's results, for Race.stream_race) is passed on too.
+    '''
+    if not 0 < distance <= MAX_DISTANCE:
+        raise ValueError(f'Race logs can only hold races up to {MAX_DISTANCE} meters')
+    header = json.dumps({'names': list(names), 'distance': distance}).encode()
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        snapshots = iter(snapshots)
+        while True:
+            try:
+                second, positions = next(snapshots)
+            except StopIteration as stop:
+                return stop.value
+            f.write(struct.pack('<H', second))
+            # Positions are kept between the start and finish so they never wrap around when encoded
+            f.write(np.round(np.clip(positions, 0, distance)*SCALE).astype('<u2').tobytes())
+            yield second, positions
+
+def read_log(path):
+    '''Returns the header of a race log and a generator of its snapshots, read one at a time.'''
+    f = open(path, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise ValueError(f'{path} is not a race log')
+    length, = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(length))
+    num_horses = len(header['names'])
+    def snapshots():
+        with f:
+            while True:
+                record = f.read(2 + 2*num_horses)
+                if len(record) < 2 + 2*num_horses:
+                    return
+                second, = struct.unpack('<H', record[:2])
+                yield second, np.frombuffer(record[2:], dtype='<u2').astype(np.float32)/SCALE
+    return header, snapshots()
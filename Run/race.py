@@ -1,160 +1,172 @@
-import pandas as pd
 import numpy as np
-from math import ceil
-import sqlite3
 import utils
-from pprint import pprint
-import requests
-from bs4 import BeautifulSoup
+import engine
+import metrics
+import logging
 from HorseDB import HorseDB
+from results_cache import ResultsCache
+import playback
 import os
+import time
+import threading
+from functools import lru_cache, cached_property
+from concurrent.futures import ProcessPoolExecutor
 
+log = logging.getLogger(__name__)
+# pandas and the scraper (requests, bs4) are slow to import, and random and user generated races with a
+# track snapshot need neither, so they are only imported by the methods that use them
+
+@lru_cache(maxsize=None)
+def get_horse_names():
+    '''Returns the names of Kentucky Derby winners in horse_names.txt, read once.'''
+    names_file = os.path.join(os.path.dirname(__file__), 'horse_names.txt')
+    with open(names_file, 'r') as h:
+        return tuple(line.strip() for line in h if line.strip())
 
-URL =  'https://www.horseracingnation.com/horse/'
 
 class Horse():
     # Horse object will be an individual participant in a race.
     # They will each have a velocity determined by their top_speed, 
     # consistency, and endurance attributes.
+    # Attributes are kept in slots instead of a dictionary per horse, since many horses can be held at once
+    __slots__ = ('name', 'real', 'top_speed', 'consistency', 'endurance', 'distances', 'mps_mean', 'mps_std',
+                 'first_seen', 'stdev_stats', 'fatigue_stats', 'velocity', 'stdev', 'fatigue', 'position', 'finished')
     
-    def __init__(self, name, speed_rating=None, cons_rating=None, end_rating=None, real_horse=False):
+    def __init__(self, name, speed_rating=None, cons_rating=None, end_rating=None, real_horse=False, times_df=None, fit=None):
         self.name = name
         self.real = real_horse
         if not self.real: # User generated horses get 1-8 ratings for top speed, consistency, endurance
             self.top_speed = speed_rating
             self.consistency = cons_rating
             self.endurance = end_rating
+        elif times_df is not None: # Race data that was already fetched with scraper.FETCHER.get_all_times
+            log.debug('%s has %d past races', self.name, len(times_df), extra={'horse':self.name, 'races':len(times_df)})
+            if len(times_df) == 0: # If the horseracingnation.com has a page for the horse but no data
+                raise ValueError(f"Data not found for horse: {self.name}") # Used for website error handling
+            self.summarize_races(times_df['distance'].to_numpy(dtype=float), times_df['finish_time'].to_numpy(dtype=float))
         else:
-            # If the horse is real, get their race data
-            self.times_df = self.__get_horse_data() 
-            print(len(self.times_df))
-            if len(self.times_df) == 0: # If the horseracingnation.com has a page for the horse but no data
+            # If the horse is real, use their saved parameters (unless they were already found with horse_params.PARAMS.get_fits)
+            if fit is None:
+                import horse_params
+                fit = horse_params.PARAMS.get_fits([self.name])[self.name]
+            if fit is None:
                 raise ValueError(f"Data not found for horse: {self.name}") # Used for website error handling
+            self.load_fit(fit)
         self.position = 0  # How far the horse is on the track in meters
         self.finished = False
     
-    def __get_horse_page(self):
-        """Returns the horse's webpage on horseracingnation.com"""
-        # Transform user given horse name into the format necessary for the url
-        # This transformed name is the 'suffix' of the url
-        suffix = '_'.join(self.name.split(' ')).replace("'",'')
-        result = requests.get(URL + suffix)
-        doc = BeautifulSoup(result.text, "html.parser")
-        return doc
-
-    def __get_horse_data(self):
-        """
-        Returns time and distance data for all of the horse's races that have 
-        been tracked on horseracingnation.com.
-        """
-        print(self.name) 
-        data = {'distance':[], 'finish_time':[]}    
-        doc = self.__get_horse_page()
-        # Extract the location of the horse's time and distance data for all races
-        for row in doc.find_all('tbody')[1].find_all('tr'):
-            dist = row.find_all('td')[3].text
-            time = row.find_all('td')[9].text
-            data['distance'].append(utils.convert_to_meters(dist))
-            data['finish_time'].append(utils.mins_to_secs(time))
-        time_df = pd.DataFrame.from_dict(data)
-        return time_df
-    
-    def get_velocity(self, times_df, distance):
-        """Decides the horse's velocity in meters per second and assigns it as an attribute."""
-        if self.real: # Real horse's times will be decided by their past races
-            adjust = False
-            times_df = self.times_df.copy()
-            # If the horse has no data at their current race's distance...
-            # find a distance that they HAVE run that is closest
-            if not any(times_df.distance - distance == 0): 
-                new_distance = utils.get_closest_dist(distance, times_df)
-                dist_diff = distance - new_distance
-                distance = new_distance
-                adjust = True # Since the distance is not the same, the velocity will need to be adjusted
-                              # This accounts for a horse's meters per second getting slower as distance increases because of fatigue
-            times_df = times_df[times_df.distance == distance] 
-            # Convert finish times into meters per second
-            mps = distance/times_df['finish_time']
-            if adjust: # Horse's lose about 0.5 meters per second for every additional 100 meters 
-                       # So, if we are using data from a shorter race, decrease the horse's mps accordingly 
-                mps -= 0.5*dist_diff/100
-        else: # If it's a user generated horse, ratings will be assigned
-            # Separate top_speeds into 8 quantiles to represent the 1-8 ratings
-            times_df['rating'] = -pd.qcut(times_df['top_speed'], 8, labels=False) + 8
-            # Get appropriate rating based on horse's top_speed rating
-            samples = times_df[times_df.rating == self.top_speed]
-            mps = distance/samples['top_speed'] # meters per second
-        # Get an xbar and sigma value to be used to randomly sample a normal distribution
-        # For real horses, this will be the avg. and standard dev. of their times at the distance
-        # For user generated horses, this will be the avg and standard. dev. of the times in the quantile group assigned to their rating
-        xbar = mps.mean() 
-        if len(mps) == 1: # If there is only one race, just use the time from that race
+    def summarize_races(self, distances, finish_times):
+        """
+        Boils a real horse's past races down to the mean and standard deviation of their meters
+        per second at each distance they've raced, which is all their parameters depend on.
+        """
+        mps = distances/finish_times # Convert finish times into meters per second
+        self.distances, first, inverse = np.unique(distances, return_index=True, return_inverse=True)
+        # Distances in the order they first show up in the horse's races, which decides ties for the closest distance
+        self.first_seen = np.argsort(first)
+        counts = np.bincount(inverse)
+        self.mps_mean = np.bincount(inverse, mps)/counts
+        squares = np.bincount(inverse, (mps - self.mps_mean[inverse])**2)
+        # Distances with only one race have no spread
+        self.mps_std = np.sqrt(squares/np.maximum(counts - 1, 1))
+        # A horse's stdev and fatigue don't depend on the race's distance, so they are found once
+        min_stdev = self.mps_std.min()
+        xbar = self.mps_std.mean()
+        if len(self.distances) == 1:
             sigma = 0
         else:
-            sigma =  mps.std()
+            sigma = self.mps_std.std(ddof=1)
+        self.stdev_stats = (min_stdev, xbar, sigma)
+        # Fatigue is how much their mps drops per every 100 meters the race distance increases
+        if len(self.distances) > 1:
+            min_idx = self.mps_mean.argmin()
+            max_idx = self.mps_mean.argmax()
+            time_diff = self.mps_mean[max_idx] - self.mps_mean[min_idx]
+            dist_diff = self.distances[max_idx] - self.distances[min_idx]
+            self.fatigue_stats = (time_diff/(dist_diff/100), 0) # mps difference per 100 meters
+        else: # If the horse has only raced one distance, just set their fatigue to 1
+            self.fatigue_stats = (1, 0)
+        return
+    
+    def get_fit(self):
+        """Returns a real horse's summarized races (see summarize_races) as a JSON-ready dictionary, for horse_params.py."""
+        return {'distances': self.distances.tolist(), 'first_seen': self.first_seen.tolist(), 'mps_mean': self.mps_mean.tolist(),
+                'mps_std': self.mps_std.tolist(), 'stdev_stats': [float(x) for x in self.stdev_stats],
+                'fatigue_stats': [float(x) for x in self.fatigue_stats]}
+    
+    def load_fit(self, fit):
+        """Sets a real horse's summarized races from a dictionary made by get_fit."""
+        self.distances = np.array(fit['distances'], dtype=float)
+        self.first_seen = np.array(fit['first_seen'], dtype=int)
+        self.mps_mean = np.array(fit['mps_mean'], dtype=float)
+        self.mps_std = np.array(fit['mps_std'], dtype=float)
+        self.stdev_stats = tuple(fit['stdev_stats'])
+        self.fatigue_stats = tuple(fit['fatigue_stats'])
+        return
+    
+    def closest_distance(self, distance):
+        """
+        Returns the index (in self.distances) of the distance the horse has raced that is closest to
+        the given distance, favoring distances within 50 meters or longer (as in utils.get_closest_dist).
+        """
+        options = self.first_seen[self.distances[self.first_seen] >= distance - 50]
+        if len(options) == 0:
+            options = self.first_seen
+        return options[np.abs(self.distances[options] - distance).argmin()]
+    
+    def get_velocity(self, rating_table, distance):
+        """Decides the horse's velocity in meters per second and assigns it as an attribute."""
+        xbar, sigma = self.velocity_params(rating_table, distance)
         self.velocity = np.random.normal(xbar, sigma) # This is to keep things stochastic so odds can realistically be created
         return
     
-    def get_stdev(self, times_df, distance):
+    def velocity_params(self, rating_table, distance):
+        """
+        Returns the mean and standard deviation of the normal distribution 
+        the horse's velocity is sampled from. User generated horses look these up
+        in their track's rating_table (Track.velocity_table).
+        """
+        if not self.real: # If it's a user generated horse, use the stats of the quantile group assigned to their rating
+            xbar, sigma = rating_table[self.top_speed]
+            return xbar, sigma
+        # Real horse's times will be decided by their past races at this distance
+        # If the horse has no data at their current race's distance, use the closest distance that they HAVE run
+        idx = self.closest_distance(distance)
+        xbar = self.mps_mean[idx]
+        if self.distances[idx] != distance: # Horse's lose about 0.5 meters per second for every additional 100 meters 
+                                            # So, if we are using data from a shorter race, decrease the horse's mps accordingly 
+            xbar -= 0.5*(distance - self.distances[idx])/100
+        # For real horses, sigma is the standard dev. of their times at the distance (0 if there is only one race)
+        sigma = self.mps_std[idx]
+        return xbar, sigma
+    
+    def get_stdev(self, rating_table, distance):
         """
         Decides and assignes the standard deviation in meters per second for the horse's velocity
         """
-        if self.real: # Real horses will get the standard deviation of their past times at the current race's distance
-            times_df = self.times_df.copy()
-            if not any(times_df.distance - distance == 0):
-                distance = utils.get_closest_dist(distance, times_df)
-            times_df['finish_time'] = times_df['distance']/times_df['finish_time'] # Get meters per second
-            samples = times_df.groupby(['distance'],as_index=False).std() # Get standard deviations for each distance
-        else: # User generated horses will get standard deviations decided by their rating's quantile from the database
-            times = times_df[['horse_id','finish_time']].copy()
-            # Adjust times to get meters per second
-            times['finish_time'] = distance/times['finish_time'] 
-            st_devs = times.groupby(['horse_id'],as_index=False).std()
-            st_devs['rating'] = -pd.qcut(st_devs['finish_time'], 8, labels=False) + 8
-            samples = st_devs[st_devs.rating == self.consistency]
-        samples = samples.fillna(0) # If 'na' is returned as a standard deviation
-        min_stdev = min(samples.finish_time)
-        xbar = samples.finish_time.mean()
-        if len(samples) == 1:
-            sigma = 0
-        else:
-            sigma = samples.finish_time.std()
+        min_stdev, xbar, sigma = self.stdev_params(rating_table, distance)
         self.stdev = max((min_stdev, np.random.normal(xbar, sigma)))
         return
     
-    def get_fatigue(self, times_df, distance):
+    def stdev_params(self, rating_table, distance):
+        """
+        Returns the minimum, mean, and standard deviation of the normal distribution
+        the horse's stdev is sampled from. User generated horses look these up
+        in their track's rating_table (Track.stdev_table).
+        """
+        if not self.real: # User generated horses will get standard deviations decided by their rating's quantile from the database
+            min_stdev, xbar, sigma = rating_table[self.consistency]
+            return min_stdev, xbar, sigma
+        # Real horses get the spread of the standard deviations of their past times at each distance
+        return self.stdev_stats
+    
+    def get_fatigue(self, rating_table, distance):
         '''
         Decides and assigns how much a horse will slow down towards the end of a race.
         This is decided by how much the horse's mps results slow down as a result in increased distance.
         '''
-        if self.real: # If the horse is real, their fatigue score will be how much their mps drops per every 100 meters 
-                      # the race distance increases
-            times_df = self.times_df.copy()
-            times_df['finish_time'] = times_df['distance']/times_df['finish_time']
-            times_df = times_df.groupby('distance', as_index=False).mean()
-            if len(times_df) > 1:
-                min_idx = times_df.finish_time.argmin()
-                max_idx = times_df.finish_time.argmax()
-                time_diff = times_df.iloc[max_idx]['finish_time'] - times_df.iloc[min_idx]['finish_time']
-                dist_diff = times_df.iloc[max_idx]['distance'] - times_df.iloc[min_idx]['distance']
-                adj_time_diff = time_diff/(dist_diff/100) # mps difference per 100 meters
-                self.fatigue = adj_time_diff
-            else: # If the horse has only raced one distance, just set their fatigue to 1
-                self.fatigue = 1
-        else:
-            # For user generated horses fatigue will be decided by how much they slow down over a single race
-            # Time in last section of race v.s. first full speed section (not first section b/c they need to accelerate so it will be slower)
-            # Determine the number of sections recorded in the race
-            num_sects = distance // 400 + (distance % 400 > 50)
-            last_sect = 'time' + str(num_sects)
-            # Subtract section 2's mps from the last section's mps to get a time difference
-            times_df['time_diff'] = 400/times_df[last_sect] - 400/times_df['time2']
-            times = times_df[['horse_id','time_diff']]
-            times = times.groupby(['horse_id'],as_index=False).mean()
-            times['rating'] = -pd.qcut(times['time_diff'], 8, labels=False) + 8
-            samples = times[times.rating == self.endurance]
-            xbar, sigma = samples.time_diff.mean(), samples.time_diff.std()
-            self.fatigue = np.random.normal(xbar, sigma)
+        xbar, sigma = self.fatigue_params(rating_table, distance)
+        self.fatigue = np.random.normal(xbar, sigma)
         # Control outliers
         if self.fatigue > 2:
             self.fatigue = 2
@@ -162,147 +174,603 @@ class Horse():
             self.fatigue = -2
         return
     
-    def move(self, distance):
-        """
-        Determine the step length for a horse and update their current position. 
-        This is just the meters a horse traveled in a given second.
-        """
-        if not self.finished:
-            # Randomly sample step length from normal distribution
-            # Determined by horse's velocity and standard dev.
-            step = np.random.normal(self.velocity, self.stdev)
-            # Fatigue will factor in for the last 400 meters
-            if self.position >= distance - 400:
-                # Subtract the horse's step length depending on endurance rating
-                step -= self.fatigue
-            self.position += step
-            # After each quarter of the race, increase stdev and fatigue
-            if self.position % (distance/4) < step:
-                self.stdev *= 2
-                self.fatigue *= 1.1
-        return
+    def fatigue_params(self, rating_table, distance):
+        '''
+        Returns the mean and standard deviation of the normal distribution the horse's 
+        fatigue is sampled from. Real horses have a fixed fatigue, so their standard deviation is 0.
+        User generated horses look these up in their track's rating_table (Track.fatigue_table).
+        '''
+        if self.real: # If the horse is real, their fatigue score will be how much their mps drops per every 100 meters 
+                      # the race distance increases (see summarize_races)
+            return self.fatigue_stats
+        else: # For user generated horses fatigue will be decided by how much they slow down over a single race
+            xbar, sigma = rating_table[self.endurance]
+            return xbar, sigma
     
 class Track:    
     # The Track object is the racetrack the race takes place on
     # It can vary in distance
     # Horse data will be an attribute of the track, because it depends on distance
-    def __init__(self, distance):
+    # The 1-8 rating groups only depend on this data, so their stats are found once here for every user generated horse
+    SNAPSHOT_DATA = ['grouped_data', 'ungrouped_data', 'horse_stats', 'velocity_table', 'stdev_table', 'fatigue_table']
+    
+    def __init__(self, distance, use_snapshot=True):
         self.distance = distance
         self.__DB = HorseDB()
-        self.grouped_data = self.__DB.get_grouped_data({'distance':distance})
-        self.ungrouped_data = self.__DB.get_ungrouped_data({'distance':distance})
+        # If the track has been exported to a snapshot, the rating tables are memory mapped from it
+        # so no queries or dataframes are needed to build the track
+        with metrics.phase('track'):
+            self.__snapshot = self.__DB.load_snapshot(distance, self.SNAPSHOT_DATA) if use_snapshot else None
+        if self.__snapshot is not None: # Plain array views of the mapped tables, which are much faster to index than memmaps
+            self.velocity_table = np.asarray(self.__snapshot['velocity_table'])
+            self.stdev_table = np.asarray(self.__snapshot['stdev_table'])
+            self.fatigue_table = np.asarray(self.__snapshot['fatigue_table'])
+        # Otherwise the tables are built the first time a user generated horse needs them (see load_tables), so
+        # races between real horses can be run at distances with no data in the database
+    
+    @metrics.timed('track')
+    def load_tables(self):
+        """Returns the velocity, stdev, and fatigue rating tables, building them from the database the first time."""
+        return self.velocity_table, self.stdev_table, self.fatigue_table
+    
+    @cached_property
+    def velocity_table(self):
+        return self.get_velocity_table()
+    
+    @cached_property
+    def stdev_table(self):
+        return self.get_stdev_table()
+    
+    @cached_property
+    def fatigue_table(self):
+        return self.get_fatigue_table()
+    
+    @property
+    def grouped_data(self):
+        return self.get_data('grouped_data', self.__DB.get_grouped_data)
+    
+    @property
+    def ungrouped_data(self):
+        return self.get_data('ungrouped_data', self.__DB.get_ungrouped_data)
+    
+    @property
+    def horse_stats(self):
+        return self.get_data('horse_stats', self.__DB.get_horse_stats)
+    
+    def get_data(self, name, query):
+        """Returns a dataframe of track data from the track's snapshot, or from the database if there isn't one."""
+        if self.__snapshot is not None:
+            import pandas as pd
+            return pd.DataFrame(self.__snapshot[name])
+        return query({'distance':self.distance})
+    
+    def save_snapshot(self):
+        """Exports the track's data and rating tables so tracks of this distance can be built without the database."""
+        self.__DB.save_snapshot(self.distance, {name:getattr(self, name) for name in self.SNAPSHOT_DATA})
+        return
+    
+    @staticmethod
+    def to_rating_table(stats):
+        """
+        Turns a dataframe of stats indexed by rating into an array where
+        row i holds the stats for rating i (row 0 is unused).
+        """
+        table = np.full((9, stats.shape[1]), np.nan)
+        table[stats.index.astype(int)] = stats.to_numpy()
+        return table
+    
+    @staticmethod
+    def to_ratings(values):
+        """
+        Returns the 1-8 rating of each value by which eighth of the values it falls in, 8 for the
+        lowest and 1 for the highest (NaN for missing values).
+        """
+        import pandas as pd
+        return -pd.qcut(values, 8, labels=False) + 8
+    
+    def get_velocity_table(self):
+        """Returns the mean and standard deviation of meters per second for each speed rating."""
+        times_df = self.grouped_data.copy()
+        if len(times_df) == 0: # Used for website error handling
+            raise ValueError(f"No race data at {self.distance} meters for created horses")
+        # Separate top_speeds into 8 quantiles to represent the 1-8 ratings
+        times_df['rating'] = self.to_ratings(times_df['top_speed'])
+        times_df['mps'] = self.distance/times_df['top_speed'] # meters per second
+        stats = times_df.groupby('rating').mps.agg(['mean', 'std', 'count'])
+        stats.loc[stats['count'] == 1, 'std'] = 0 # If there is only one horse, just use the time from that horse
+        return self.to_rating_table(stats[['mean', 'std']])
+    
+    def get_stdev_table(self):
+        """
+        Returns the minimum, mean, and standard deviation of each horse's
+        standard deviation in meters per second for each consistency rating.
+        """
+        st_devs = self.horse_stats[['horse_id', 'mps_std']].copy()
+        if len(st_devs) == 0:
+            raise ValueError(f"No race data at {self.distance} meters for created horses")
+        st_devs['rating'] = self.to_ratings(st_devs['mps_std'])
+        stats = st_devs.groupby('rating').mps_std.agg(['min', 'mean', 'std', 'count'])
+        stats.loc[stats['count'] == 1, 'std'] = 0
+        return self.to_rating_table(stats[['min', 'mean', 'std']])
+    
+    def get_fatigue_table(self):
+        """
+        Returns the mean and standard deviation of how much horses slow down over
+        a single race for each endurance rating.
+        """
+        # Time in last section of race v.s. first full speed section (not first section b/c they need to accelerate so it will be slower)
+        times = self.horse_stats[['horse_id', 'time_diff']].copy()
+        if len(times) == 0:
+            raise ValueError(f"No race data at {self.distance} meters for created horses")
+        times['rating'] = self.to_ratings(times['time_diff'])
+        stats = times.groupby('rating').time_diff.agg(['mean', 'std'])
+        return self.to_rating_table(stats)
     
 class Race:
     # These are the distances that have enough data to make a simulation
     VALID_DISTANCES = [1200, 1400, 1650, 1000, 1600, 1800]
+    # Most races simulated at once by simulate_races, this caps the memory used by the race engine
+    SIM_CHUNK = 2000
+    # Process pools used to run simulations on several cores, shared by every race and keyed by number of workers
+    POOLS = {}
+    POOLS_LOCK = threading.Lock()
+    # With sims='auto', odds are simulated in growing batches until they stop changing
+    MIN_BATCH = 500 # Races in the first batch
+    MAX_SIMS = 200000 # Most races simulated before giving up on the odds settling
+    TIME_BUDGET = 5 # Most seconds spent simulating
+    Z_SCORE = 3 # Width of each horse's win probability interval, in standard errors
+    LONGSHOT = 0.01 # Horses whose chance of winning is surely below this are settled at long odds
+    REL_WIDTH = 0.3 # Horses whose interval is narrower than this fraction of their chance of winning (or losing) are settled
+    # Odds are simulated with exact finish times (engine.run_exact) even when single races use one second ticks, since
+    # it's several times faster and finishes horses the same way to within a fraction of a percent (see tests/test_engine.py)
+    EXACT_ODDS = True
+    # Bets on the horses finishing in the top 1, 2 (place), and 3 (show) spots
+    MARKETS = {'win': 1, 'place': 2, 'show': 3}
+    # Simulated counts saved for every session and process, so the same race isn't simulated twice
+    RESULTS = ResultsCache()
     
     # The Race object consists of horses and a race track and is responsible for simulating the race
     # A randomized race can be generated if the user does not manually input horses and/or a track
-    def __init__(self, horses='random', track='random', num_horses='random', sims=50):
+    # Odds can be simulated on several cores (workers), and a seed makes them reproducible
+    # If sims is 'auto', simulations are run until the odds settle (see get_adaptive_odds)
+    # With exact=True, races are run by engine.run_exact, which gives finish times in fractions of a second
+    # (odds are simulated with it either way, unless EXACT_ODDS is turned off)
+    # With get_odds=False, the odds aren't simulated when the race is created (batch.py prices many races together)
+    # With use_cache=False, odds are always simulated instead of reusing the saved results of the same race
+    def __init__(self, horses='random', track='random', num_horses='random', sims=50, workers=1, seed=None, exact=False,
+                 get_odds=True, use_cache=True):
         self.horses = horses
         self.track = track
         self.num_horses = num_horses
         self.sims = sims
+        self.workers = workers
+        self.seed = seed
+        self.exact = exact
+        self.use_cache = use_cache
         if self.horses == 'random':
             self.generate_random_horses()
         if self.track == 'random':
             self.generate_random_track()
-        self.odds = self.get_race_odds()
-        pprint(self.odds)
+        if not get_odds:
+            return
+        if self.sims == 'auto':
+            self.adaptive = self.get_adaptive_odds()
+            self.odds = self.adaptive['odds']
+            self.sims = self.adaptive['sims']
+        else:
+            self.odds = self.get_race_odds()
+        log.info('Odds: %s', self.odds, extra={'odds':self.odds, 'sims':self.sims})
               
     def generate_random_horses(self):
         """Generates random horses with names and ratings"""
         if self.num_horses == 'random':
             self.num_horses = np.random.randint(4, 21) # Min of 4 horses, max of 20
-        horses = []
-        # Get random names from list of Kentucky Derby Winners
-        names_file = os.path.join(os.path.dirname(__file__), 'horse_names.txt')
-        with open(names_file, 'r') as h:
-            names = h.readlines()
-        num_names = len(names)
-        used_names = []
-        for _ in range(self.num_horses): # Randomly create specified number of horses 
-            while True:
-                name_idx = np.random.randint(1, num_names)
-                name = names[name_idx].split('\n')[0]
-                if name not in used_names:
-                    used_names.append(name)
-                    break
-            # Randomly assign ratings 1-8
-            speed = np.random.randint(1, 9)
-            cons = np.random.randint(1, 9)
-            endur = np.random.randint(1, 9)
-            horses.append(Horse(name, speed, cons, endur))
-        h.close()
-        self.horses = horses          
+        # Random names from the list of Kentucky Derby Winners, drawn without replacement so no two horses share one
+        names = np.random.choice(get_horse_names(), self.num_horses, replace=False)
+        # Randomly assign speed, consistency, and endurance ratings 1-8
+        ratings = np.random.randint(1, 9, (self.num_horses, 3))
+        self.horses = [Horse(str(name), *map(int, rating)) for name, rating in zip(names, ratings)]
             
+    @classmethod
+    def export_snapshots(cls):
+        """Exports a snapshot of the track for every valid distance."""
+        for distance in cls.VALID_DISTANCES:
+            Track(distance, use_snapshot=False).save_snapshot()
+        return
+    
     def generate_random_track(self):
         # Randomly create race track from list of valid distances
         track_idx = np.random.randint(1, len(self.VALID_DISTANCES))
         distance = self.VALID_DISTANCES[track_idx]
         self.track = Track(distance)
     
-    def preprocess(self):
+    @metrics.timed('preprocess')
+    def preprocess(self, params=None):
         # Before each race starts, make sure conditions are proper for beginning of race
         # In the case of resimulating from the same object, some attributes need to be reverted to initial settings
-        # Decide each horse's attributes
+        # Every horse's attributes are drawn at once from their distribution parameters (get_params), as sample_params
+        # draws a batch of one race, and returned as arrays ordered like self.horses
+        if params is None:
+            params = self.get_params()
         self.winner = False
+        velocity, stdev, fatigue = (draws[0] for draws in self.sample_params(params, 1))
+        for horse, horse_velocity, horse_stdev, horse_fatigue in zip(self.horses, velocity.tolist(), stdev.tolist(), fatigue.tolist()):
+            horse.velocity, horse.stdev, horse.fatigue = horse_velocity, horse_stdev, horse_fatigue
+            horse.position = 0
+            horse.finished = False
+        return velocity, stdev, fatigue
+    
+    def load_track(self):
+        """Builds the track's rating tables if any horse is user generated, so their queries are timed as the track's phase."""
+        if not all(horse.real for horse in self.horses):
+            self.track.load_tables()
+        return
+    
+    def get_params(self):
+        """
+        Returns arrays of every horse's velocity (mean, sigma), stdev (min, mean, sigma), and 
+        fatigue (mean, sigma) distribution parameters. These only depend on the horses and the
+        track, so they are found once and reused for every simulation.
+        """
+        self.load_track()
+        return self.field_params()
+    
+    @metrics.timed('params')
+    def field_params(self):
+        """Returns get_params' arrays, once the track's rating tables are built."""
         distance = self.track.distance
+        params = []
         for horse in self.horses:
             if horse.real:
-                try:
-                    horse.get_velocity(None, distance)
-                    horse.get_stdev(None, distance)
-                    horse.get_fatigue(None, distance)
-                except:
-                    return horse.name # This is used for error handling on the website
+                params.append(horse.velocity_params(None, distance) + horse.stdev_params(None, distance) 
+                              + horse.fatigue_params(None, distance))
             else:
-                horse.get_velocity(self.track.grouped_data.copy(), distance)
-                horse.get_stdev(self.track.ungrouped_data.copy(), distance)
-                horse.get_fatigue(self.track.ungrouped_data.copy(), distance)
-            horse.position = 0
-            horse.finished = False
+                params.append(horse.velocity_params(self.track.velocity_table, distance)
+                              + horse.stdev_params(self.track.stdev_table, distance)
+                              + horse.fatigue_params(self.track.fatigue_table, distance))
+        return np.array(params, dtype=float).T
+    
+    @staticmethod
+    def sample_params(params, sims, rng=None):
+        """
+        Samples each horse's velocity, stdev, and fatigue for a (sims x horses) batch of races.
+        Values are drawn from rng (a numpy Generator), or from np.random's global state if it isn't given.
+        """
+        if rng is None:
+            rng = np.random
+        v_mean, v_sigma, s_min, s_mean, s_sigma, f_mean, f_sigma = params
+        size = (sims, params.shape[1])
+        velocity = rng.normal(v_mean, v_sigma, size)
+        stdev = np.fmax(s_min, rng.normal(s_mean, s_sigma, size))
+        fatigue = np.clip(rng.normal(f_mean, f_sigma, size), -2, 2) # Control outliers
+        return velocity, stdev, fatigue
+    
+    @classmethod
+    def count_results(cls, params, distance, sims, chunk_size, rng=None, exact=False, seeds=None):
+        """
+        Simulates sims races between horses with the given parameters, chunk_size races at a time.
+        Returns the win, place, exacta, trifecta, and finish time counts described in simulate_races.
+        """
+        return cls.count_races(params, [params.shape[1]], distance, sims, chunk_size, rng, exact, seeds)[0]
+    
+    @classmethod
+    @metrics.timed('simulate')
+    def count_races(cls, params, fields, distance, sims, chunk_size, rng=None, exact=False, seeds=None):
+        """
+        Simulates sims runs of several races at the same distance at once. The horses of every race
+        are side by side in params, and fields holds how many horses each race has, in order.
+        Every horse is run by the same engine call, then each race's horses are ranked against each other.
+        Returns a list with the counts described in simulate_races for each race.
+        With seeds (one SeedSequence per chunk), each chunk draws from its own generator, so the counts
+        don't depend on which chunks are run together. Without seeds or an rng, batches are drawn from a
+        generator seeded from np.random's global state, which np.random.seed still controls but draws
+        normals faster than the global state itself.
+        """
+        if rng is None and seeds is None:
+            rng = np.random.default_rng(np.random.randint(2**32, size=4))
+        run = engine.run_exact if exact else engine.run
+        counts = [{'wins': np.zeros(n, dtype=int), 'places': np.zeros((n, n), dtype=int),
+                   'exacta': np.zeros((n, n), dtype=int), 'trifecta': np.zeros((n, n, n), dtype=int),
+                   'times': np.zeros((n, 0), dtype=int)} for n in fields]
+        bounds = np.cumsum([0] + list(fields))
+        metrics.count('races_simulated', sims*len(fields))
+        for chunk, start in enumerate(range(0, sims, chunk_size)):
+            if seeds is not None:
+                rng = np.random.default_rng(seeds[chunk])
+            velocity, stdev, fatigue = cls.sample_params(params, min(chunk_size, sims - start), rng)
+            finish_time, finish_position = run(velocity, stdev, fatigue, distance, rng)
+            for result, first, last in zip(counts, bounds[:-1], bounds[1:]):
+                cls.tally(result, finish_time[:, first:last], finish_position[:, first:last], exact)
+        return counts
+    
+    @staticmethod
+    def tally(result, finish_time, finish_position, exact=False):
+        """Adds a (sims x horses) batch of one race's finishes to its counts."""
+        num_horses = finish_time.shape[1]
+        horse_idx = np.arange(num_horses)
+        order = engine.rank(finish_time, finish_position) # Horse indices of each race in finishing order
+        if exact: # Exact times are counted in the second they fall in
+            finish_time = np.ceil(finish_time).astype(int)
+        result['wins'] += np.bincount(order[:, 0], minlength=num_horses)
+        # Column p of order holds the horse that finished in place p+1
+        result['places'] += np.bincount((order*num_horses + horse_idx).ravel(), 
+                                        minlength=num_horses**2).reshape(num_horses, num_horses)
+        # Only the first three finishers matter for exotic bets, so each race's top three is counted
+        # as a single number instead of keeping whole finishing orders
+        # Fields too small for a bet leave its counts at 0
+        if num_horses >= 2:
+            first_two = order[:, 0]*num_horses + order[:, 1]
+            result['exacta'] += np.bincount(first_two, minlength=num_horses**2).reshape(num_horses, num_horses)
+        if num_horses >= 3:
+            result['trifecta'] += np.bincount(first_two*num_horses + order[:, 2], 
+                                              minlength=num_horses**3).reshape(num_horses, num_horses, num_horses)
+        # Count finish times, growing the table if this batch had a slower finish than the last ones
+        max_time = finish_time.max() + 1
+        if max_time > result['times'].shape[1]:
+            result['times'] = np.pad(result['times'], ((0, 0), (0, max_time - result['times'].shape[1])))
+        result['times'][:, :max_time] += np.bincount((horse_idx*max_time + finish_time).ravel(),
+                                                     minlength=num_horses*max_time).reshape(num_horses, max_time)
         return
     
+    @staticmethod
+    def merge_results(results):
+        """Adds together the counts of several batches of races."""
+        max_time = max(result['times'].shape[1] for result in results)
+        merged = {key: sum(result[key] for result in results) for key in results[0] if key != 'times'}
+        merged['times'] = sum(np.pad(result['times'], ((0, 0), (0, max_time - result['times'].shape[1])))
+                              for result in results)
+        return merged
+    
+    @property
+    def odds_exact(self):
+        """Whether the race's odds are simulated with exact finish times: always with exact=True, and with EXACT_ODDS otherwise."""
+        return self.exact or self.EXACT_ODDS
+    
+    @classmethod
+    def get_pool(cls, workers):
+        """Returns the shared process pool with the given number of workers, starting it the first time."""
+        with cls.POOLS_LOCK:
+            if workers not in cls.POOLS:
+                cls.POOLS[workers] = ProcessPoolExecutor(max_workers=workers)
+            return cls.POOLS[workers]
+    
+    def simulate_races(self, sims=None, chunk_size=None, workers=None, seed=None):
+        """
+        Simulates a batch of races at once. Races are run SIM_CHUNK (or chunk_size) at a time to bound memory.
+        With more than one worker (or a seed), every chunk draws from its own random generator, spawned from the
+        seed, and the chunks are split between the workers. The results are the same for a given seed and chunk
+        size, whatever the number of workers (races shorter than a chunk per worker use fewer workers).
+        Returns a dictionary of arrays ordered like self.horses:
+            wins: number of races each horse won
+            places: places[i, p] is the number of times horse i finished in place p+1
+            exacta: exacta[i, j] is the number of times horse i finished first and horse j second
+            trifecta: trifecta[i, j, k] is the number of times horses i, j, and k finished first, second, and third
+            times: times[i, t] is the number of times horse i finished in t seconds
+        """
+        if sims is None:
+            sims = self.sims
+        if chunk_size is None:
+            chunk_size = self.SIM_CHUNK
+        if workers is None:
+            workers = self.workers
+        if seed is None:
+            seed = self.seed
+        params = self.get_params()
+        distance = self.track.distance
+        if workers == 1 and seed is None:
+            return self.count_results(params, distance, sims, chunk_size, exact=self.odds_exact)
+        # Each chunk's random stream is independent of the others, of the workers it's split between,
+        # and of how the processes are scheduled
+        seeds = np.random.SeedSequence(seed).spawn(-(-sims//chunk_size))
+        if workers == 1:
+            return simulate_share(params, distance, sims, chunk_size, seeds, self.odds_exact)
+        # Each worker runs a run of whole chunks, and only the last worker's last chunk can be short
+        shares = [chunks for chunks in np.array_split(np.arange(len(seeds)), workers) if len(chunks)]
+        pool = self.get_pool(workers)
+        # The workers' own timings stay in their processes, so the whole parallel batch is timed here
+        with metrics.phase('simulate'):
+            futures = [pool.submit(simulate_share, params, distance, min(sims, (chunks[-1] + 1)*chunk_size) - chunks[0]*chunk_size,
+                                   chunk_size, seeds[chunks[0]:chunks[-1] + 1], self.odds_exact)
+                       for chunks in shares]
+            results = self.merge_results([future.result() for future in futures])
+        metrics.count('races_simulated', sims)
+        return results
+    
     def get_race_odds(self):
         # Get betting odds based on n Monte Carlo simulations
-        odds = {horse.name:0 for horse in self.horses}
-        for _ in range(self.sims):
-            self.simulate_race(show_finishers=False)
-            odds[self.winner.name] += 1
-        for key, value in odds.items():
-            if value == 0: # In the case a horse never wins 
-                odds[key] += 0.75 # To avoid division error/infinitely positive odds
-            if odds[key] == self.sims: # In the case a horse always wins 
-                odds[key] -= 0.25 # To avoid division error/infinitely negative odds
-            odds[key] = utils.round_odds(utils.convert_to_odds(odds[key], self.sims))
-        return odds
+        # The counts are kept so every other bet can be priced from the same races (see get_bet_probabilities)
+        key = self.results_key(self.sims) if self.use_cache else None
+        self.results = None if key is None else self.RESULTS.get(key)
+        if self.results is None:
+            self.results = self.simulate_races()
+            if key is not None:
+                self.RESULTS.put(key, self.results)
+        return self.wins_to_odds(self.results['wins'], self.sims)
     
-    def simulate_race(self, show_finishers=True):
-        self.preprocess()
-        place = 1 # Ordering of horse's when they finish (incremented after each horse finishes)
-        time = 0
-        results = {} # This will store the horse name, finishing place, and finish time to be displayed on website
+    def results_key(self, sims, **options):
+        """Returns the key the race's simulated counts are saved under (see ResultsCache.make_key)."""
+        return self.RESULTS.make_key(self.get_params(), self.track.distance, sims, self.seed, self.odds_exact,
+                                     self.SIM_CHUNK, **options)
+    
+    def get_bet_probabilities(self, results=None):
+        """
+        Returns the chance of every bet paying out, using the races simulated for the odds (or the given results):
+            win, place, show: each horse's chance of finishing in the top 1, 2, or 3
+            exacta: chance of each (first, second) pair of horses, most likely first
+            trifecta: chance of each (first, second, third) trio of horses, most likely first
+        Exacta and trifecta only include finishes that happened at least once.
+        """
+        if results is None:
+            results = self.results
+        sims = results['wins'].sum() # Every race has exactly one winner
+        names = [horse.name for horse in self.horses]
+        bets = {}
+        for market, top in self.MARKETS.items():
+            finishes = results['places'][:, :top].sum(axis=1)
+            bets[market] = {name: float(count/sims) for name, count in zip(names, finishes)}
+        for market in ('exacta', 'trifecta'):
+            counts = results[market]
+            hits = np.flatnonzero(counts)
+            hits = hits[np.argsort(-counts.ravel()[hits], kind='stable')]
+            bets[market] = {tuple(names[i] for i in np.unravel_index(hit, counts.shape)): float(counts.ravel()[hit]/sims) 
+                            for hit in hits}
+        return bets
+    
+    @metrics.timed('odds')
+    def wins_to_odds(self, wins, sims):
+        """Converts each horse's number of wins in sims races into a clean odds ratio."""
+        numers, denoms = self.get_odds_table(sims)
+        return {horse.name:(int(numers[win]), int(denoms[win])) for horse, win in zip(self.horses, wins)}
+    
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def get_odds_table(sims):
+        """
+        Returns arrays of the odds for every number of wins (0 to sims) in sims races.
+        Races are usually priced with the same number of simulations, so the table is
+        built once and every later race only looks up its horses' wins.
+        """
+        wins = np.arange(sims + 1, dtype=float)
+        wins[0] += 0.75 # To avoid division error/infinitely positive odds when a horse never wins
+        wins[sims] = sims - 0.25 # To avoid division error/infinitely negative odds when a horse always wins
+        numers, denoms = utils.round_odds_array(*utils.convert_to_odds(wins, sims))
+        return numers.astype(np.int32), denoms.astype(np.int32)
+    
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def get_odds_steps(longest=1000):
+        """
+        Returns the sorted win probabilities where a horse's rounded odds change to the next odds, for odds
+        up to longest-1 either way. Odds are rounded to quarters below 4-1 and to whole numbers above it
+        (see utils.round_odds), so every place they can change is found by rounding both sides of each quarter.
+        """
+        def chances(ratios): # Win probabilities of plus odds of ratio-1 and minus odds of 1-ratio
+            return np.concatenate([1/(1 + ratios), ratios/(1 + ratios)])
+        ratios = np.arange(4, 4*longest + 1)/4
+        below = utils.round_odds_array(*utils.convert_to_odds(chances(ratios*(1 - 1e-4)), 1))
+        above = utils.round_odds_array(*utils.convert_to_odds(chances(ratios*(1 + 1e-4)), 1))
+        return np.unique(chances(ratios)[(below[0] != above[0]) | (below[1] != above[1])])
+    
+    def odds_settled(self, wins, sims, z):
+        """
+        Returns True if more simulations can only move any horse's odds by one step. A horse's odds have settled
+        when its win probability interval crosses at most one of the places where the rounded odds change, when
+        the interval is narrower than REL_WIDTH of its chance of winning (or losing), or when its chance of winning
+        (or losing) is surely below LONGSHOT. Long shots' odds change every few hundredths of a percent, so they
+        settle by the width of their interval.
+        """
+        lower, upper = utils.win_interval(wins, sims, z)
+        check = (upper >= self.LONGSHOT) & (lower <= 1 - self.LONGSHOT)
+        wins, lower, upper = wins[check], lower[check], upper[check]
+        if ((wins == 0) | (wins == sims)).any(): # These horses' odds are only placeholders until they've won (or lost) once
+            return False
+        steps = self.get_odds_steps()
+        crossed = np.searchsorted(steps, upper) - np.searchsorted(steps, lower)
+        p = wins/sims
+        narrow = upper - lower <= self.REL_WIDTH*np.minimum(p, 1 - p)
+        return bool(((crossed <= 1) | narrow).all())
+    
+    def get_adaptive_odds(self, max_sims=None, time_budget=None, z=None):
+        """
+        Simulates races in batches until every horse's odds have settled (see odds_settled),
+        max_sims races have been run, or the next batch would run past time_budget seconds.
+        Each batch doubles the races run so far. Returns a dictionary of:
+            odds: each horse's odds, as in get_race_odds
+            sims: number of races simulated
+            converged: whether the odds settled before running out of races or time
+            widths: width of each horse's win probability interval
+        """
+        if max_sims is None:
+            max_sims = self.MAX_SIMS
+        if time_budget is None:
+            time_budget = self.TIME_BUDGET
+        if z is None:
+            z = self.Z_SCORE
+        key = self.results_key('auto', max_sims=max_sims, z=z) if self.use_cache else None
+        self.results = None if key is None else self.RESULTS.get(key)
+        if self.results is not None: # Only odds that settled are saved, since the rest depend on the time budget
+            wins = self.results['wins']
+            sims, converged = int(wins.sum()), True
+        else:
+            sims, converged = self.simulate_until_settled(max_sims, time_budget, z)
+            wins = self.results['wins']
+            if key is not None and converged:
+                self.RESULTS.put(key, self.results)
+        lower, upper = utils.win_interval(wins, sims, z)
+        widths = {horse.name:float(high - low) for horse, low, high in zip(self.horses, lower, upper)}
+        return {'odds': self.wins_to_odds(wins, sims), 'sims': sims, 'converged': converged, 'widths': widths}
+    
+    def simulate_until_settled(self, max_sims, time_budget, z):
+        """Runs get_adaptive_odds' batches of races, keeping the counts in self.results. Returns the races run and whether the odds settled."""
+        start = time.perf_counter()
+        sims = 0
+        batch = self.MIN_BATCH
         while True:
-            time += 1
-            for horse in self.horses:
-                horse.move(self.track.distance)
-            # if any horses finish, display what place they finished in and mark that they finished
-            if any([horse.position >= self.track.distance and not horse.finished  for horse in self.horses]):
-                finishers = [horse for horse in self.horses if horse.position >= self.track.distance and not horse.finished]
-                ranked_finishers = sorted(finishers, key=lambda x:x.position)
-                # If horses finish at the same time step, the horse with the highest travelled distance wins
-                for horse in ranked_finishers:
-                    if show_finishers:
-                        print(f'{horse.name} finishes number {place} in {time} seconds!')
-                        results[horse.name] = (time, place)
-                    horse.finished = True
-                    if not self.winner:
-                        self.winner = horse
-                    place += 1
-            # End race when all horses finish
-            if all([horse.finished for horse in self.horses]):
-                break 
+            # Every batch gets its own seed so a seeded race stays reproducible
+            seed = None if self.seed is None else (self.seed, sims)
+            results = self.simulate_races(sims=batch, seed=seed)
+            self.results = results if sims == 0 else self.merge_results([self.results, results])
+            wins = self.results['wins']
+            sims += batch
+            converged = self.odds_settled(wins, sims, z)
+            elapsed = time.perf_counter() - start
+            if converged or sims >= max_sims:
+                break
+            # Batch sizes don't depend on timing, so a seeded race that settles within the budget is reproducible
+            batch = min(sims, max_sims - sims)
+            if elapsed*(sims + batch)/sims > time_budget: # The next batch would run past the time budget
+                break
+        return sims, converged
+    
+    def field_arrays(self):
+        """Returns the velocity, stdev, and fatigue of the horses in the race, as arrays ordered like self.horses."""
+        return self.preprocess(self.get_params())
+    
+    def simulate_race(self, show_finishers=True):
+        run = engine.run_exact if self.exact else engine.run
+        finish_time, finish_position = run(*self.field_arrays(), self.track.distance)
+        results = self.finish_race(finish_time, finish_position, show_finishers, self.exact)
         if show_finishers: # Only return the results if we want to see the finishers
             return results
-        return
\ No newline at end of file
+        return
+    
+    def stream_race(self, every=1, log_path=None):
+        """
+        Runs the race one second at a time (engine.stream), yielding (second, positions) every `every` seconds
+        so it can be watched as it's run, and saving every yielded snapshot to a race log if log_path is given.
+        The generator returns the results, as simulate_race does. Streamed races always use one second ticks,
+        so finish times are whole seconds even when the race is exact.
+        """
+        names = [horse.name for horse in self.horses]
+        snapshots = playback.downsample(engine.stream(*self.field_arrays(), self.track.distance), every)
+        if log_path is not None:
+            snapshots = playback.write_log(log_path, names, self.track.distance, snapshots)
+        finish_time, finish_position = yield from snapshots
+        return self.finish_race(finish_time, finish_position)
+    
+    def finish_race(self, finish_time, finish_position, show_finishers=True, exact=False):
+        """Sets each horse's finishing position and the winner, and returns the results as {name: (seconds, place)}."""
+        results = {} # This will store the horse name, finishing place, and finish time to be displayed on website
+        # If horses finish at the same time step, they are ordered by distance travelled
+        for place, idx in enumerate(engine.rank(finish_time, finish_position), start=1):
+            horse = self.horses[idx]
+            horse.position = finish_position[idx]
+            horse.finished = True
+            if show_finishers:
+                # Exact finish times are shown to the hundredth of a second
+                seconds = round(float(finish_time[idx]), 2) if exact else int(finish_time[idx])
+                log.info('%s finishes number %d in %s seconds!', horse.name, place, seconds,
+                         extra={'horse':horse.name, 'place':place, 'seconds':seconds})
+                results[horse.name] = (seconds, place)
+            if not self.winner:
+                self.winner = horse
+        return results
+
+@lru_cache(maxsize=None)
+def get_track(distance):
+    '''Returns the Track for a distance, built once and shared by everything in the process (seasons, the odds service's workers).'''
+    return Track(distance)
+
+def simulate_share(params, distance, sims, chunk_size, seeds, exact=False):
+    '''Runs one worker's share of a parallel batch of races, each chunk with a generator made from its seed.'''
+    return Race.count_results(params, distance, sims, chunk_size, exact=exact, seeds=seeds)
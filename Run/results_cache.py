@@ -0,0 +1,128 @@
+import io
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import numpy as np
+import engine
+import metrics
+
+# Simulated race counts are saved in a SQLite database shared by every session and process,
+# so a race that has already been simulated (a preset race, or the same request again) isn't simulated again
+# Results are keyed by a hash of everything they depend on: the horses' distribution parameters, the distance,
+# the number of races, the seed, and the engine version. Once the saved results are over max_bytes,
+# the least recently used ones are deleted.
+
+CACHE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'results_cache.db')
+MAX_BYTES = 256*1024*1024
+
+log = logging.getLogger(__name__)
+
+class ResultsCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ready = False
+        return
+
+    def connect(self):
+        """Returns a new connection, creating the database the first time. Connections are cheap, and aren't shared between threads."""
+        if not self.ready:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        if not self.ready:
+            conn.execute("PRAGMA journal_mode = WAL;") # Readers don't wait for writers in other processes
+            conn.execute("""CREATE TABLE IF NOT EXISTS tResults
+                            (key TEXT PRIMARY KEY, results BLOB, size INTEGER, last_used REAL);""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_results_used ON tResults(last_used);")
+            self.ready = True
+        return conn
+
+    @staticmethod
+    def make_key(params, distance, sims, seed=None, exact=False, chunk_size=None, **options):
+        """
+        Returns the hash of everything a race's simulated counts depend on. Without a seed, the chunk size
+        only changes which random numbers are drawn, so races that differ only in it share results. The
+        number of workers never changes a race's results (see Race.simulate_races), so it isn't in the key.
+        Any other options (like adaptive settings) are added to the key.
+        """
+        settings = {'engine': engine.VERSION, 'distance': float(distance), 'sims': sims, 'exact': bool(exact),
+                    'seed': seed, **options}
+        if seed is not None:
+            settings.update(chunk_size=chunk_size)
+        digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode())
+        digest.update(np.ascontiguousarray(params, dtype=float).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def to_blob(results):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **results)
+        return buffer.getvalue()
+
+    @staticmethod
+    def from_blob(blob):
+        with np.load(io.BytesIO(blob)) as arrays:
+            return {name: arrays[name] for name in arrays.files}
+
+    def get(self, key):
+        """Returns the saved counts for a key, or None if they aren't saved (or the cache can't be read)."""
+        try:
+            with metrics.phase('results_cache'):
+                conn = self.connect()
+                try:
+                    row = conn.execute("SELECT results FROM tResults WHERE key = ?;", (key,)).fetchone()
+                    if row is not None:
+                        conn.execute("UPDATE tResults SET last_used = ? WHERE key = ?;", (time.time(), key))
+                finally:
+                    conn.close()
+        except (sqlite3.Error, OSError) as error:
+            log.warning('Results cache could not be read: %s', error, extra={'path':self.path})
+            return None
+        metrics.count('results_cache_hits' if row is not None else 'results_cache_misses')
+        return None if row is None else self.from_blob(row[0])
+
+    def put(self, key, results):
+        """Saves a race's counts, then deletes the least recently used results until the cache fits in max_bytes."""
+        blob = self.to_blob(results)
+        try:
+            with metrics.phase('results_cache'):
+                conn = self.connect()
+                try:
+                    conn.execute("BEGIN IMMEDIATE;") # One process writes and evicts at a time
+                    conn.execute("INSERT OR REPLACE INTO tResults VALUES (?, ?, ?, ?);", (key, blob, len(blob), time.time()))
+                    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tResults;").fetchone()[0]
+                    if total > self.max_bytes:
+                        evicted = 0
+                        for old_key, size in conn.execute("SELECT key, size FROM tResults ORDER BY last_used;").fetchall():
+                            if total <= self.max_bytes:
+                                break
+                            conn.execute("DELETE FROM tResults WHERE key = ?;", (old_key,))
+                            total -= size
+                            evicted += 1
+                        metrics.count('results_cache_evictions', evicted)
+                    conn.execute("COMMIT;")
+                finally:
+                    conn.close()
+        except (sqlite3.Error, OSError) as error: # A full disk or read-only folder only means results aren't saved
+            log.warning('Results cache could not be written: %s', error, extra={'path':self.path})
+        return
+
+    def clear(self):
+        conn = self.connect()
+        try:
+            conn.execute("DELETE FROM tResults;")
+        finally:
+            conn.close()
+        return
+
+    def info(self):
+        """Returns the number of saved results, their total size, and the size limit."""
+        conn = self.connect()
+        try:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tResults;").fetchone()
+        finally:
+            conn.close()
+        return {'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes}
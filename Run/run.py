@@ -1,7 +1,15 @@
+import os
+import time
 import streamlit as st
-from utils import furlongs_to_meters, miles_to_meters
+from utils import parse_distance
 from race import Horse, Track, Race
-import pandas as pd
+import metrics
+# The scraper and pandas are imported when they're first needed, so the page is drawn without waiting for them
+
+# When set (like http://127.0.0.1:8600), odds and races are simulated by odds_server.py instead of in the app
+SERVICE_URL = os.environ.get('ODDS_SERVICE_URL')
+PLAYBACK_DELAY = 0.05 # Seconds each frame of a watched race is shown for
+PLAYBACK_EVERY = 2 # Race seconds between frames of a watched race
 
 class MyApp:
     def __init__(self):
@@ -29,15 +37,22 @@ class MyApp:
         st.sidebar.markdown("1. Create a race by selecting track distance and adding horses.")
         st.sidebar.markdown("2. View expected odds for each horse.")
         st.sidebar.markdown("3. Click 'Race!' to see simulation results.") 
+        # Only this session's requests are timed for the sidebar, the process' metrics stay as HORSE_METRICS set them
+        self.timing = st.sidebar.checkbox("Show timings", value=metrics.ENABLED, help="Time each step of getting odds and racing")
         self.streamlit_defaults()
         # Two main columns
         col1, col2 = st.columns(2, gap = 'large')
         self.get_race_info(col1)
         self.get_horse_info(col1)
         left, _ = col1.columns(2)
-        self.sims = int(left.text_input("##### Enter Number of Simulations", "50"))
+        sims = left.text_input("##### Enter Number of Simulations", "50", help="Enter 'auto' to simulate until the odds stop changing")
+        self.sims = 'auto' if sims.strip().lower() == 'auto' else int(sims)
+        self.exact = left.checkbox("Exact finish times", help="Time races to fractions of a second instead of whole seconds")
+        self.watch = left.checkbox("Watch the race", help="Show the horses running before the results (finish times are whole seconds)")
         if col1.button("Get Odds"): # Show odds if button clicked
-            result = self.get_odds(col2)
+            with metrics.request(self.timing) as timings:
+                result = self.get_odds(col2)
+            self.show_timings(timings)
             if result != None:
                 col1.write(result)
         else:
@@ -46,7 +61,9 @@ class MyApp:
                 col2.write('### Odds:')
                 col2.dataframe(st.session_state.ODDS, width = 300, hide_index=True)
         if col2.button("Race!"):
-            result = self.simulate_race(col2)
+            with metrics.request(self.timing) as timings:
+                result = self.simulate_race(col2)
+            self.show_timings(timings)
             if result != None:
                 col2.write(result)
         return
@@ -62,14 +79,8 @@ class MyApp:
             column.write("Enter track distance specifying furlongs (f), miles (mi), or meters (m):"
                      "  \n **Example:** 6f, 1mi, 1200m")
             track_distance = column.text_input(f"Enter Track Distance", "")
-            if 'f' in track_distance:
-                track_distance = track_distance.replace('f','F')
-                track_distance = furlongs_to_meters(track_distance)
-            elif 'mi' in track_distance:
-                track_distance = track_distance.replace('mi','M')
-                track_distance = miles_to_meters(track_distance)
-            else:
-                track_distance = track_distance.replace('m','')
+            if track_distance: # Nothing is entered when the page first loads
+                track_distance = parse_distance(track_distance)
         elif race_type == "Create Horses":
             self.race_type = "create"
             track_distance = column.selectbox("Select Track Distance (meters)", [1000, 1200, 1400, 1600, 1650, 1800, "random"])
@@ -106,13 +117,18 @@ class MyApp:
     
     def initialize_race(self):
         '''Use the data gained from prompts to initialize race and store it in the session state.'''
+        if SERVICE_URL:
+            return self.request_race()
         horses = []
         if self.distance != "random":
             track = Track(int(self.distance))
         if self.race_type == "real":
+            # Every horse's saved parameters are found (and any that are missing or old fetched at once) before the horses are created
+            from horse_params import PARAMS
+            fits = PARAMS.get_fits(list(self.horses.keys()))
             for name in self.horses.keys():
                 try:
-                    horses.append(Horse(name, real_horse=True))
+                    horses.append(Horse(name, real_horse=True, fit=fits[name]))
                 except: # If a horse fails to be initialized, it has no data, so return error prompt to be written on the screen
                     return f"No data available for {name}"
             num_horses = self.num_horses
@@ -126,20 +142,35 @@ class MyApp:
                 track = 'random'
             horses = 'random'
             num_horses = 'random'
-        self.race = Race(horses, track, num_horses, sims=self.sims)
+        self.race = Race(horses, track, num_horses, sims=self.sims, exact=self.exact)
         st.session_state.RACE = self.race
                 
+    def request_race(self):
+        '''Has the odds service simulate the race's odds, storing the race it sends back in the session state.'''
+        from odds_server import RemoteRace
+        body = {'race_type': self.race_type, 'distance': self.distance, 'horses': self.horses,
+                'num_horses': getattr(self, 'num_horses', 'random'), 'sims': self.sims, 'exact': self.exact}
+        try:
+            self.race = RemoteRace(SERVICE_URL, body)
+        except (ValueError, OSError) as error: # Bad races, a busy service, or a service that can't be reached
+            return str(error)
+        st.session_state.RACE = self.race
+    
     def get_odds(self, column):
         '''Writes the simulated odds of the race to the screen in a DataFrame.'''
         result = self.initialize_race()
         if result != None:
             return result
+        import pandas as pd
         odds = pd.DataFrame()
         odds['Name'] = self.race.odds.keys()
         odds['Odds'] = [str(odd[0]) + '-' + str(odd[1])for odd in self.race.odds.values()]
         st.session_state.ODDS = odds
         column.write('### Odds:')
         column.dataframe(odds, width = 300, hide_index=True)
+        if self.sims == 'auto': # Show how many simulations it took for the odds to settle
+            settled = 'settled' if self.race.adaptive['converged'] else 'stopped early'
+            column.write(f"Odds {settled} after {self.race.sims} simulations")
     
     def simulate_race(self, column):
         '''Simulates a race and writes the results to the screen.'''
@@ -147,11 +178,45 @@ class MyApp:
             result = self.initialize_race()
             if result != None:
                 return result
-        results = st.session_state.RACE.simulate_race()
+        try:
+            # Races from the odds service can't be watched, so they're only shown once they're over
+            if self.watch and hasattr(st.session_state.RACE, 'stream_race'):
+                results = self.watch_race(st.session_state.RACE, column)
+            else:
+                results = st.session_state.RACE.simulate_race()
+        except (ValueError, OSError) as error: # Only races from the odds service fail here
+            return str(error)
         column.write('### Race Results')
         for horse, result in results.items():
             column.write(f'{horse} finishes number {result[1]} in {result[0]} seconds!')
-        
+        return
+
+    def watch_race(self, race, column):
+        '''Draws each horse's progress as the race is run, and returns the results once every horse has finished.'''
+        track = column.empty()
+        snapshots = race.stream_race(every=PLAYBACK_EVERY)
+        while True:
+            try:
+                second, positions = next(snapshots)
+            except StopIteration as stop:
+                return stop.value
+            with track.container():
+                st.write(f'### {second} seconds')
+                for horse, position in zip(race.horses, positions):
+                    # A horse's first steps can be backwards, and progress bars only go from 0 to 1
+                    st.progress(min(max(float(position)/race.track.distance, 0.0), 1.0), text=horse.name)
+            time.sleep(PLAYBACK_DELAY)
+
+    def show_timings(self, timings):
+        '''Writes how long each step of the last request took to the sidebar.'''
+        if not self.timing:
+            return
+        import pandas as pd
+        st.sidebar.subheader("Timings")
+        st.sidebar.dataframe(pd.DataFrame({'Step': list(timings), 'ms': [round(seconds*1000, 2) for seconds in timings.values()]}),
+                             hide_index=True)
+        st.sidebar.download_button("Download metrics (Prometheus)", metrics.to_prometheus(), file_name='metrics.prom')
+        return
 
     def streamlit_defaults(self):
         '''
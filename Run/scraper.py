@@ -0,0 +1,135 @@
+import os
+import time
+import logging
+from functools import lru_cache
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+try:
+    import lxml.html
+except ImportError: # Pages are parsed with the slower html.parser when lxml isn't installed
+    lxml = None
+import utils
+import metrics
+
+# Real horses' race data is scraped from horseracingnation.com
+# All of a race's horses are fetched at the same time over one pool of connections,
+# and the parsed results are kept on disk so a horse's page is only requested again once its data is old
+
+URL = 'https://www.horseracingnation.com/horse/'
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'data', 'horse_cache')
+CACHE_TTL = 24*60*60 # Seconds before a horse's saved data is fetched again
+TIMEOUT = (3.05, 10) # Seconds to wait to connect to and read from the website
+WORKERS = 8 # Most horse pages requested at once
+DIST_COL, TIME_COL = 3, 9 # Columns of the results table holding each race's distance and finish time
+
+# Horses mostly race the same handful of distances, so each distance string is only converted once
+get_meters = lru_cache(maxsize=None)(utils.convert_to_meters)
+
+log = logging.getLogger(__name__)
+
+class HorseFetcher:
+    def __init__(self, base_url=URL, cache_dir=CACHE_DIR, ttl=CACHE_TTL, workers=WORKERS, timeout=TIMEOUT, retries=3):
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.workers = workers
+        self.timeout = timeout
+        # Failed requests and server errors are retried with increasing waits between them
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        return
+
+    @staticmethod
+    def get_suffix(name):
+        """Transforms a horse's name into the format used at the end of their page's url."""
+        # This transformed name is the 'suffix' of the url
+        return '_'.join(name.split(' ')).replace("'",'')
+
+    def get_horse_page(self, name):
+        """
+        Returns the html of the horse's webpage on horseracingnation.com.
+        Raises requests.HTTPError for error pages (like a missing horse or a server error), so they're never cached.
+        """
+        result = self.session.get(self.base_url + self.get_suffix(name), timeout=self.timeout)
+        result.raise_for_status()
+        return result.text
+
+    @staticmethod
+    def get_results(html):
+        """
+        Returns the distance and finish time strings of every row in the page's
+        results table (the second table body on the page).
+        """
+        if lxml is not None:
+            # lxml builds the tree in C, and only the results table's rows are visited
+            table = lxml.html.fromstring(html).xpath('(//tbody)[2]')[0]
+            rows = ([td.text_content() for td in row.iter('td')] for row in table.iter('tr'))
+        else:
+            # Only table bodies (and the tags inside them) are kept in the tree
+            doc = BeautifulSoup(html, "html.parser", parse_only=SoupStrainer('tbody'))
+            rows = ([td.text for td in row.find_all('td')] for row in doc.find_all('tbody')[1].find_all('tr'))
+        return [(cells[DIST_COL], cells[TIME_COL]) for cells in rows]
+
+    @staticmethod
+    def read_results(html):
+        """Returns a dataframe of distance (meters) and finish time (seconds) for each race on the page."""
+        results = HorseFetcher.get_results(html)
+        data = {'distance':[get_meters(dist) for dist, _ in results],
+                'finish_time':[utils.mins_to_secs(finish_time) for _, finish_time in results]}
+        time_df = pd.DataFrame.from_dict(data)
+        return time_df
+
+    def get_horse_data(self, name):
+        """
+        Returns time and distance data for all of the horse's races that have
+        been tracked on horseracingnation.com.
+        """
+        log.info('Fetching %s', name, extra={'horse':name})
+        metrics.count('horse_pages_fetched')
+        with metrics.phase('fetch_page'):
+            html = self.get_horse_page(name)
+        with metrics.phase('parse_page'):
+            return self.read_results(html)
+
+    def get_cache_path(self, name):
+        return os.path.join(self.cache_dir, quote(self.get_suffix(name), safe='') + '.csv')
+
+    def get_times(self, name):
+        """Returns the horse's race data, from the disk cache if it was saved within the last ttl seconds."""
+        path = self.get_cache_path(name)
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < self.ttl:
+            metrics.count('horse_cache_hits')
+            return pd.read_csv(path)
+        times_df = self.get_horse_data(name)
+        # Written to a temporary file first so other sessions never read a partly written file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{id(times_df)}.tmp'
+        times_df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        return times_df
+
+    @metrics.timed('fetch')
+    def get_all_times(self, names):
+        """
+        Returns a dictionary of each horse's race data, fetching all of the horses at once.
+        Horses whose data couldn't be found get an empty dataframe.
+        """
+        def get_times(name):
+            try:
+                return self.get_times(name)
+            except Exception as error: # Missing pages, error pages, pages without results tables, and network errors
+                log.warning('Could not get %s: %s', name, error, extra={'horse':name})
+                return pd.DataFrame({'distance':[], 'finish_time':[]})
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return dict(zip(names, pool.map(get_times, names)))
+
+# Shared by every session so connections and cached results are reused
+FETCHER = HorseFetcher()
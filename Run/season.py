@@ -0,0 +1,224 @@
+import sys
+import json
+import argparse
+import contextlib
+import numpy as np
+import pandas as pd
+import engine
+import metrics
+from race import Track, Race, get_horse_names, get_track
+
+# Simulates a season of races between a pool of horses, for pricing futures (who finishes the season on top)
+# Horses are kept as arrays instead of Horse objects, so a season can have tens of thousands of them.
+# Every round, the horses that race are split into fields and each race is given a distance. All of a round's
+# races at a distance are run by the same engine call (one race per row), split between worker processes.
+# Between races, each horse's form and tiredness carry over:
+#     form: added to their velocity, it rises after finishing ahead of the middle of the field and falls after finishing behind it
+#     tiredness: added to their fatigue, it builds with every meter raced and wears off between rounds
+# Standings are kept as running totals, so no race's results are kept once the horses' totals are updated.
+
+POINTS = (10, 6, 4, 3, 2, 1) # Standings points for finishing 1st, 2nd, 3rd, ...
+FIELD = 12 # Horses in each race
+FORM_DECAY = 0.8 # Share of a horse's form kept after each race
+FORM_GAIN = 0.05 # Meters per second of form gained by winning a race (and lost by finishing last)
+TIRE_RATE = 0.05 # Tiredness gained for every 1000 meters raced
+RECOVERY = 0.7 # Share of tiredness kept from one round to the next
+
+def run_races(params, field, distance, seed, exact=False):
+    '''
+    Runs the races of a round at one distance, with each race's horses in a row of field columns.
+    Returns the place (0 for the winner) each horse finished in, in the same shape.
+    '''
+    rng = np.random.default_rng(seed)
+    velocity, stdev, fatigue = (sample.reshape(-1, field) for sample in Race.sample_params(params, 1, rng))
+    run = engine.run_exact if exact else engine.run
+    finish_time, finish_position = run(velocity, stdev, fatigue, distance, rng)
+    order = engine.rank(finish_time, finish_position)
+    places = np.empty_like(order)
+    np.put_along_axis(places, order, np.arange(field), axis=1)
+    return places
+
+class Season:
+    # A season between horses with 1-8 speed, consistency, and endurance ratings (ratings is a (horses x 3) array)
+    # Each horse races in a round with the chance participation, and races are run FIELD (or field) horses at a time
+    # The same seed and number of workers always give the same season
+    def __init__(self, names, ratings, distances=None, field=FIELD, participation=1.0, workers=1, seed=None, exact=False):
+        self.names = np.asarray(names)
+        self.ratings = np.asarray(ratings, dtype=int)
+        self.distances = list(Race.VALID_DISTANCES if distances is None else distances)
+        self.field = field
+        self.participation = participation
+        self.workers = workers
+        self.seed = seed
+        self.exact = exact
+        self.rng = np.random.default_rng(seed)
+        self.points = np.pad(POINTS, (0, max(0, field - len(POINTS))))[:field]
+        # Each horse's distribution parameters at every distance are found once from the tracks' rating tables
+        self.params = {distance: self.get_params(get_track(distance)) for distance in self.distances}
+        num_horses = len(self.names)
+        self.form = np.zeros(num_horses)
+        self.tiredness = np.zeros(num_horses)
+        self.starts = np.zeros(num_horses, dtype=int)
+        self.wins = np.zeros(num_horses, dtype=int)
+        self.top3 = np.zeros(num_horses, dtype=int)
+        self.score = np.zeros(num_horses, dtype=int)
+        self.rounds = 0
+        self.races = 0
+        return
+
+    @classmethod
+    def from_names(cls, num_horses, seed=None, **kwargs):
+        """
+        Creates a season of horses with random ratings, named from horse_names.txt.
+        Once every name is used, names are reused with a number after them.
+        """
+        names = get_horse_names()
+        names = [names[i % len(names)] + (f' {i//len(names) + 1}' if i >= len(names) else '') for i in range(num_horses)]
+        ratings = np.random.default_rng(seed).integers(1, 9, (num_horses, 3))
+        return cls(names, ratings, seed=seed, **kwargs)
+
+    @classmethod
+    def from_db(cls, distance=1200, num_horses=None, seed=None, **kwargs):
+        """
+        Creates a season of the database's horses that have run the distance 10 or more times (or a random num_horses of them).
+        Their ratings are the 1-8 quantile groups their stats fall in, the same groups Track builds its rating tables from.
+        """
+        track = get_track(distance)
+        # Every horse at the distance is rated before any are sampled, so the groups are the track's own
+        grouped, stats = track.grouped_data, track.horse_stats
+        speed = grouped[['horse_id']].assign(speed=Track.to_ratings(grouped['top_speed']))
+        stats = stats[['horse_id']].assign(consistency=Track.to_ratings(stats['mps_std']),
+                                           endurance=Track.to_ratings(stats['time_diff']))
+        horses = speed.merge(stats, on='horse_id').dropna() # Horses missing a stat can't be rated
+        if num_horses is not None:
+            horses = horses.sample(min(num_horses, len(horses)), random_state=seed)
+        ratings = horses[['speed', 'consistency', 'endurance']].to_numpy(dtype=int)
+        return cls([f'Horse {horse_id}' for horse_id in horses['horse_id']], ratings, seed=seed, **kwargs)
+
+    def get_params(self, track):
+        """Returns the (7 x horses) parameters of every horse at the track, ordered as in Race.get_params."""
+        speed, consistency, endurance = self.ratings.T
+        return np.hstack([track.velocity_table[speed], track.stdev_table[consistency], track.fatigue_table[endurance]]).T
+
+    def draw_round(self):
+        """Returns a dictionary of the round's races at each distance, as arrays of horse indices with a row per race."""
+        runners = np.flatnonzero(self.rng.random(len(self.names)) < self.participation)
+        runners = self.rng.permutation(runners)
+        num_races = len(runners)//self.field # Horses left over sit the round out
+        fields = runners[:num_races*self.field].reshape(num_races, self.field)
+        race_distances = self.rng.integers(len(self.distances), size=num_races)
+        return {self.distances[d]: fields[race_distances == d] for d in range(len(self.distances)) if (race_distances == d).any()}
+
+    def round_params(self, distance, horses):
+        """Returns the parameters of the horses racing at a distance, with their form and tiredness added."""
+        params = self.params[distance][:, horses.ravel()]
+        params[0] += self.form[horses.ravel()] # Velocity mean
+        params[5] += self.tiredness[horses.ravel()] # Fatigue mean
+        return params
+
+    @metrics.timed('season_round')
+    def run_round(self):
+        """Runs one round of races and updates every horse's totals and state. Returns the number of races run."""
+        races = self.draw_round()
+        seeds = np.random.SeedSequence(self.rng.integers(2**63)).spawn(len(races)*self.workers)
+        # Each distance's races are split into a share for each worker
+        jobs = []
+        for d, (distance, horses) in enumerate(races.items()):
+            for worker, share in enumerate(np.array_split(horses, self.workers)):
+                if len(share):
+                    jobs.append((distance, share, seeds[d*self.workers + worker]))
+        args = [(self.round_params(distance, share), self.field, distance, seed, self.exact) for distance, share, seed in jobs]
+        if self.workers == 1:
+            results = [run_races(*arg) for arg in args]
+        else:
+            pool = Race.get_pool(self.workers)
+            results = [future.result() for future in [pool.submit(run_races, *arg) for arg in args]]
+        self.tiredness *= RECOVERY
+        for (distance, horses, _), places in zip(jobs, results):
+            self.update(horses.ravel(), places.ravel(), distance)
+        num_races = sum(len(horses) for horses in races.values())
+        self.rounds += 1
+        self.races += num_races
+        metrics.count('season_races', num_races)
+        return num_races
+
+    def update(self, horses, places, distance):
+        """Adds a batch of horses' finishing places (0 for the winner) to their totals, form, and tiredness."""
+        self.starts[horses] += 1
+        self.wins[horses] += places == 0
+        self.top3[horses] += places < 3
+        self.score[horses] += self.points[places]
+        # 1 for a win, -1 for finishing last (a horse racing alone always wins)
+        result = 1 - 2*places/max(self.field - 1, 1)
+        self.form[horses] = FORM_DECAY*self.form[horses] + FORM_GAIN*result
+        self.tiredness[horses] += TIRE_RATE*distance/1000
+        return
+
+    def run(self, rounds=None, races=None, top=10):
+        """
+        Runs rounds (or until races races have been run), yielding the standings after each round as a
+        dictionary of the round, races run so far, and a dataframe of the top horses.
+        """
+        while (rounds is None or self.rounds < rounds) and (races is None or self.races < races):
+            if self.run_round() == 0: # Not enough horses raced to fill a field
+                break
+            yield {'round': self.rounds, 'races': self.races, 'leaders': self.standings(top)}
+
+    def standings(self, top=None):
+        """Returns a dataframe of the horses ordered by points, then wins (top horses only if top is given)."""
+        order = np.lexsort((-self.wins, -self.score))
+        if top is not None:
+            order = order[:top]
+        return pd.DataFrame({'name': self.names[order], 'points': self.score[order], 'wins': self.wins[order],
+                             'top3': self.top3[order], 'starts': self.starts[order],
+                             'form': self.form[order].round(3), 'tiredness': self.tiredness[order].round(3)})
+
+    def champion(self):
+        """Returns the index of the horse on top of the standings."""
+        return np.lexsort((-self.wins, -self.score))[0]
+
+def futures_odds(names, ratings, seasons=100, rounds=10, seed=None, **kwargs):
+    '''
+    Runs many seasons between the same horses and returns each horse's odds of finishing on top,
+    as a dictionary of name: odds for horses that won at least one season, shortest odds first.
+    '''
+    champions = np.zeros(len(names), dtype=int)
+    for number in range(seasons):
+        season = Season(names, ratings, seed=None if seed is None else [seed, number], **kwargs)
+        for _ in season.run(rounds, top=0):
+            pass
+        champions[season.champion()] += 1
+    numers, denoms = Race.get_odds_table(seasons)
+    return {str(names[i]): (int(numers[champions[i]]), int(denoms[champions[i]])) for i in np.argsort(-champions, kind='stable')
+            if champions[i]}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulates a season of races, writing the standings after each round as a line of JSON.')
+    parser.add_argument('--horses', type=int, default=1000, help='horses named from horse_names.txt with random ratings')
+    parser.add_argument('--db', type=int, default=None, metavar='DISTANCE', help="use the database's horses at this distance instead")
+    parser.add_argument('--rounds', type=int, default=None, help='rounds to run')
+    parser.add_argument('--races', type=int, default=None, help='races to run (stops after the round that reaches it)')
+    parser.add_argument('--field', type=int, default=FIELD, help='horses in each race')
+    parser.add_argument('--participation', type=float, default=1.0, help='chance each horse races in a round')
+    parser.add_argument('--top', type=int, default=10, help='horses shown in each round\'s standings')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes')
+    parser.add_argument('--seed', type=int, default=None, help='seed for a reproducible season')
+    parser.add_argument('--exact', action='store_true', help='use exact finish times (engine.run_exact)')
+    args = parser.parse_args(argv)
+    if args.rounds is None and args.races is None:
+        args.rounds = 10
+    options = {'field': args.field, 'participation': args.participation, 'workers': args.workers, 'exact': args.exact}
+    out = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.db is not None:
+            season = Season.from_db(args.db, seed=args.seed, **options)
+        else:
+            season = Season.from_names(args.horses, seed=args.seed, **options)
+        for standings in season.run(args.rounds, args.races, args.top):
+            standings['leaders'] = standings['leaders'].to_dict('records')
+            out.write(json.dumps(standings) + '\n')
+            out.flush()
+    return
+
+if __name__ == '__main__':
+    main()
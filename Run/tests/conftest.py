@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+# The simulator's modules are imported by name from the Run directory, as run.py imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from race import Horse
+
+def pytest_configure(config):
+    # Deselect with -m "not slow"
+    config.addinivalue_line('markers', 'slow: checks that take several seconds each')
+
+@pytest.fixture
+def real_horse():
+    '''Returns a function that creates a real horse from fitted parameters (see Horse.get_fit), without fetching anything.'''
+    def make(name, stdev_stats=(0.2, 0.25, 0.05), mps_mean=(16.5, 15.8)):
+        fit = {'distances': [1200.0, 1600.0], 'first_seen': [0, 1], 'mps_mean': list(mps_mean), 'mps_std': [0.3, 0.2],
+               'stdev_stats': list(stdev_stats), 'fatigue_stats': [0.2, 0]}
+        return Horse(name, real_horse=True, fit=fit)
+    return make
@@ -0,0 +1,17 @@
+import json
+import batch
+
+CARD = [{'race': 'R1', 'distance': 1200, 'horses': [{'name': f'Horse {i}', 'speed': 1 + i, 'consistency': 4, 'endurance': 5}
+                                                    for i in range(4)]},
+        {'race': 'R2', 'distance': 2000, 'horses': [{'name': 'Alone', 'speed': 5, 'consistency': 5, 'endurance': 5}]}]
+
+def test_price_card(monkeypatch):
+    monkeypatch.setattr(batch.Race, 'RESULTS', None) # Priced cards never read or write saved results
+    first, second = batch.price_card(CARD, sims=500, seed=3, markets=True)
+    # Created horses need data at the distance, so the 2000 meter race is an error instead of the whole card failing
+    assert second == {'race': 'R2', 'distance': 2000, 'error': 'No race data at 2000 meters for created horses'}
+    assert first['race'] == 'R1' and first['sims'] == 500 and set(first['odds']) == {f'Horse {i}' for i in range(4)}
+    assert abs(sum(first['markets']['exacta'].values()) - 1) < 1e-9
+    assert all(key.count('|') == 2 for key in first['markets']['trifecta'])
+    json.dumps(first)
+    assert list(batch.price_card(CARD[:1], sims=500, seed=3, markets=True)) == [first] # The same seed prices the same odds
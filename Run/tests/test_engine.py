@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import engine
+from race import Track, Race
+
+def test_exact_zero_stdev_takes_fixed_time():
+    # No spread and no fatigue: every stretch takes exactly its length divided by the velocity
+    finish_time, finish_position = engine.run_exact([15.0], [0.0], [0.0], 1200, np.random.default_rng(0))
+    assert finish_time[0] == pytest.approx(1200/15)
+    assert finish_position[0] == 1200
+
+def test_exact_zero_stdev_among_field_finishes():
+    rng = np.random.default_rng(1)
+    finish_time, _ = engine.run_exact(np.full((500, 4), 16.0), np.tile([0.0, 0.2, 0.0, 0.5], (500, 1)),
+                                      np.full((500, 4), 0.3), 1600, rng)
+    assert np.isfinite(finish_time).all()
+
+def test_exact_race_with_zero_stdev_horse(real_horse):
+    # A minimum stdev of 0 (like the Swift_Runner fixture's) samples stdevs of 0 for many simulations
+    horses = [real_horse('Steady', stdev_stats=(0.0, 0.0, 0.0))] + [real_horse(f'Horse {i}') for i in range(3)]
+    race = Race(horses, Track(1600, use_snapshot=False), len(horses), sims=500, exact=True, use_cache=False)
+    assert sum(race.results['wins']) == 500
+    assert len(race.simulate_race()) == len(horses)
+
+def test_exact_gives_up_on_bad_input():
+    with pytest.raises(ValueError):
+        engine.run_exact([np.nan], [0.5], [0.3], 1200, np.random.default_rng(0))
+
+def test_rank_orders_same_second_finishers_furthest_first():
+    finish_time = np.array([[60, 59, 60, 60, 61]])
+    finish_position = np.array([[1203.5, 1210.0, 1208.25, 1203.5, 1201.0]])
+    # Horse 1 finished a second earlier, horse 2 went furthest in second 60, and horses 0 and 3 tied exactly
+    assert engine.rank(finish_time, finish_position).tolist() == [[1, 2, 0, 3, 4]]
+
+@pytest.mark.parametrize('distance, speeds', [(1200, (16.9, 16.7, 16.5, 16.4, 16.3, 16.2, 16.0, 15.8)),
+                                              (1600, (15.9, 15.8, 15.6, 15.3))])
+def test_exact_odds_match_one_second_ticks(real_horse, distance, speeds):
+    # Odds are simulated with exact finish times by default (Race.EXACT_ODDS), so they have to agree with the tick engine
+    horses = [real_horse(f'Horse {i}', mps_mean=(speed, speed - 0.7)) for i, speed in enumerate(speeds)]
+    params = Race(horses, Track(distance, use_snapshot=False), len(horses), get_odds=False).get_params()
+    sims = 20000
+    ticks = Race.count_results(params, distance, sims, 2000, np.random.default_rng(0), False)
+    exact = Race.count_results(params, distance, sims, 2000, np.random.default_rng(1), True)
+    assert np.abs(ticks['wins'] - exact['wins']).max()/sims < 0.015
+    place = lambda counts: counts['places'][:, :2].sum(axis=1)/sims
+    assert np.abs(place(ticks) - place(exact)).max() < 0.02
@@ -0,0 +1,25 @@
+import horse_params
+
+def test_refit_fetches_fresh_pages(monkeypatch, tmp_path):
+    # --refit has to skip the fetcher's cached pages as well as the saved parameters
+    calls = []
+    def get_fits(store, names, offline=None, fetcher=None):
+        calls.append((store.path, store.max_age, fetcher))
+        return {name: None for name in names}
+    monkeypatch.setattr(horse_params.ParamStore, 'get_fits', get_fits)
+    path = str(tmp_path/'params.db')
+    monkeypatch.setattr(horse_params, 'PARAMS', horse_params.ParamStore(path=path))
+    horse_params.main(['Swift Runner', '--refit'])
+    (store_path, max_age, fetcher), = calls
+    assert store_path == path # Refits are saved where the shared store reads them
+    assert max_age == 0 and fetcher.ttl == 0
+    horse_params.main(['Swift Runner'])
+    assert calls[1][2] is None # Without --refit, the shared fetcher and its cache are used
+
+def test_put_keeps_only_the_newest_fit(tmp_path):
+    store = horse_params.ParamStore(path=str(tmp_path/'params.db'))
+    for fetched in (100.0, 200.0, 300.0):
+        store.put('Swift Runner', fetched, {'fetched': fetched}, 10)
+    store.put('Other Horse', 150.0, {'fetched': 150.0}, 5)
+    assert store.get('Swift Runner') == (300.0, {'fetched': 300.0})
+    assert store.info() == {'horses': 2, 'fits': 2}
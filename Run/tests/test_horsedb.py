@@ -0,0 +1,60 @@
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from HorseDB import HorseDB
+
+SNIP_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'Exploratory', 'data')
+
+@pytest.fixture
+def snips():
+    return pd.read_csv(os.path.join(SNIP_DIR, 'races_snip.csv')), pd.read_csv(os.path.join(SNIP_DIR, 'runs_snip.csv'))
+
+def rebuild(path_data, races, runs):
+    races.to_csv(path_data/'races.csv', index=False)
+    runs.to_csv(path_data/'runs.csv', index=False)
+    db = HorseDB(str(path_data))
+    db.rebuild_db()
+    return db
+
+def get_indexes(db):
+    with sqlite3.connect(db.path_db) as conn:
+        return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';")}
+
+def test_rebuild_without_regular_horses(tmp_path, snips):
+    # No horse in the snip csvs has run a distance 10 times
+    db = rebuild(tmp_path, *snips)
+    stats = db.get_horse_stats({'distance':1200})
+    assert len(stats) == 0 and list(stats.columns) == ['horse_id', 'mps_std', 'time_diff']
+    assert 'idx_stats_distance' in get_indexes(db)
+
+def test_rebuild_with_regular_horse(tmp_path, snips):
+    races, runs = snips
+    # Horse 7 runs ten 1200 meter races
+    races = pd.concat([races[races['distance'] == 1200].iloc[[0]]]*10, ignore_index=True)
+    races['race_id'] = range(10)
+    runs = pd.concat([runs[runs['race_id'] == 1].iloc[[0]]]*10, ignore_index=True)
+    runs['race_id'] = range(10)
+    runs['horse_id'] = 7
+    runs['finish_time'] += [i/10 for i in range(10)]
+    db = rebuild(tmp_path, races, runs)
+    stats = db.get_horse_stats({'distance':1200})
+    assert stats['horse_id'].tolist() == [7] and stats['mps_std'].iloc[0] > 0
+    assert db.get_grouped_data({'distance':1200})['num_races'].tolist() == [10]
+    assert 'idx_stats_distance' in get_indexes(db)
+
+def test_save_snapshot_replaces_the_old_one(tmp_path):
+    db = HorseDB(str(tmp_path))
+    db.save_snapshot(1200, {'velocity_table': np.zeros(3), 'stdev_table': np.zeros(3)})
+    db.save_snapshot(1200, {'velocity_table': np.ones(3), 'stdev_table': np.ones(3)})
+    snapshot = db.load_snapshot(1200, ['velocity_table', 'stdev_table'])
+    assert snapshot['velocity_table'].tolist() == [1, 1, 1]
+    assert sorted(os.listdir(tmp_path/'snapshot')) == ['1200']
+
+def test_incomplete_snapshot_is_not_loaded(tmp_path):
+    # A snapshot missing a table (or being replaced while it's read) falls back to the database instead of failing
+    db = HorseDB(str(tmp_path))
+    db.save_snapshot(1200, {'velocity_table': np.zeros(3)})
+    assert db.load_snapshot(1200, ['velocity_table', 'stdev_table']) is None
+    assert db.load_snapshot(1600, ['velocity_table']) is None
@@ -0,0 +1,21 @@
+import metrics
+
+def test_request_is_timed_without_enabling_metrics(monkeypatch):
+    # One session's "Show timings" shouldn't start (or stop) the metrics of every other session
+    monkeypatch.setattr(metrics, 'ENABLED', False)
+    monkeypatch.setattr(metrics, 'REGISTRY', metrics.Registry())
+    with metrics.request() as timings:
+        with metrics.phase('track'):
+            pass
+        metrics.timed('odds')(lambda: None)()
+    assert set(timings) == {'track', 'odds', 'total'}
+    assert metrics.summary() == {'counters': {}, 'phases': {}}
+
+def test_untimed_request_keeps_process_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, 'ENABLED', True)
+    monkeypatch.setattr(metrics, 'REGISTRY', metrics.Registry())
+    with metrics.request(False) as timings:
+        with metrics.phase('track'):
+            pass
+    assert timings == {}
+    assert metrics.summary()['phases']['track']['calls'] == 1
@@ -0,0 +1,85 @@
+from math import ceil
+import numpy as np
+import pytest
+import utils
+from race import Race
+
+# The per-horse odds conversion and recursive rounding from before odds were vectorized, kept as they were
+# so the odds table (Race.get_odds_table and utils.round_odds_array) is checked against them
+
+def original_convert_to_odds(wins, trials):
+    numer = 1 - (wins/trials)
+    denom = wins/trials
+    scalar = 1/denom
+    numer *= scalar
+    denom = 1
+    if numer < denom:
+        denom = (denom * 100) / (numer * 100)
+        denom = round(denom,5)
+        numer = 1
+    return (numer, denom)
+
+def original_round_plus(frac_tuple):
+    numer, denom = frac_tuple
+    if numer >= 4 and denom == 1:
+        numer = numer//1
+        return (int(numer), int(denom))
+    elif denom == 4:
+        return (int(numer//1), int(denom//1))
+    elif numer % 1 < 0.5:
+        return (int(numer//1), int(denom//1))
+    else:
+        return original_round_plus((numer*2, denom*2))
+
+def original_round_minus(frac_tuple):
+    numer, denom = frac_tuple
+    if denom >= 4 and numer == 1:
+        denom = ceil(denom)
+        return (int(numer), int(denom))
+    elif numer == 4:
+        return (int(ceil(numer)), int(ceil(denom)))
+    elif denom % 1 >= 0.5:
+        return (int(round(numer)), int(round(denom)))
+    else:
+        return original_round_minus((numer*2, denom*2))
+
+def original_round_odds(frac_tuple):
+    numer, denom = frac_tuple
+    if numer > denom:
+        odds = original_round_plus(frac_tuple)
+    else:
+        odds = original_round_minus(frac_tuple)
+    if odds[0] == odds[1]:
+        return (1, 1)
+    else:
+        return odds
+
+def original_odds(wins, sims):
+    '''Odds of a horse that won wins of sims races, as the original Race.get_race_odds found them.'''
+    if wins == 0:
+        wins += 0.75
+    if wins == sims:
+        wins -= 0.25
+    return original_round_odds(original_convert_to_odds(wins, sims))
+
+def check_table(sims, wins):
+    numers, denoms = Race.get_odds_table(sims)
+    expected = [original_odds(win, sims) for win in wins]
+    assert list(zip(numers[wins].tolist(), denoms[wins].tolist())) == expected
+
+def test_every_win_count_up_to_600_sims():
+    for sims in range(1, 601):
+        check_table(sims, np.arange(sims + 1))
+
+@pytest.mark.parametrize('sims', [4096, 9999, 10**4, 12345, 5*10**4, 65536, 10**5, 128000, 2*10**5, 333333, 5*10**5,
+                                  pytest.param(999999, marks=pytest.mark.slow), pytest.param(10**6, marks=pytest.mark.slow)])
+def test_every_win_count_large_sims(sims):
+    # About 8 seconds each for the largest tables
+    check_table(sims, np.arange(sims + 1))
+
+def test_scalar_rounding_matches_original():
+    # Random probabilities through the cached scalar path, including ones far from any table
+    for p in np.random.default_rng(0).uniform(1e-4, 1 - 1e-4, 20000):
+        frac = utils.convert_to_odds(p, 1)
+        assert frac == original_convert_to_odds(p, 1)
+        assert utils.round_odds(frac) == original_round_odds(frac)
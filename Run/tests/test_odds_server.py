@@ -0,0 +1,50 @@
+import json
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import odds_server
+from results_cache import ResultsCache
+
+def odds_body(seed, **options):
+    horses = {f'Horse {i}': [1 + i, 4, 5] for i in range(4)}
+    return json.dumps({'race_type': 'create', 'distance': 1200, 'horses': horses, 'sims': 300, 'seed': seed, **options}).encode()
+
+def test_price_race(monkeypatch, tmp_path):
+    monkeypatch.setattr(odds_server.Race, 'RESULTS', ResultsCache(str(tmp_path/'results.db')))
+    race = odds_server.read_race(json.loads(odds_body(1)))
+    result = odds_server.price_race(race, 300, 1, False, True)
+    assert result['race'] == race and result['sims'] == 300 and set(result['odds']) == {f'Horse {i}' for i in range(4)}
+    assert all(key.count('|') == 1 for key in result['markets']['exacta'])
+    json.dumps(result)
+
+def test_identical_requests_share_a_simulation_and_full_queues_are_turned_away(monkeypatch, tmp_path):
+    monkeypatch.setattr(odds_server.Race, 'RESULTS', ResultsCache(str(tmp_path/'results.db')))
+    gate, calls = threading.Event(), []
+    price_race = odds_server.price_race
+    def held_price_race(*args):
+        calls.append(args)
+        gate.wait(10) # Simulations stay pending until every request has been sent
+        return price_race(*args)
+    monkeypatch.setattr(odds_server, 'price_race', held_price_race)
+    server = odds_server.OddsServer(workers=1, max_queue=2)
+    server.pool.shutdown()
+    server.pool = ThreadPoolExecutor(max_workers=2) # Threads see the held price_race, unlike worker processes
+
+    async def send():
+        requests = [asyncio.create_task(server.route('POST', '/odds', odds_body(seed))) for seed in (1, 1, 2)]
+        await asyncio.sleep(0.1)
+        busy = await server.route('POST', '/odds', odds_body(3))
+        pending = server.pending
+        gate.set()
+        return await asyncio.gather(*requests), busy, pending
+
+    try:
+        (same, again, other), busy, pending = asyncio.run(send())
+    finally:
+        server.pool.shutdown()
+    assert pending == 2 and len(calls) == 2 # Seeds 1 and 2, with the second seed 1 request sharing the first's simulation
+    assert busy[0] == HTTPStatus.TOO_MANY_REQUESTS
+    assert same[0] == again[0] == other[0] == HTTPStatus.OK
+    assert again[1] is same[1] and other[1]['race'] == same[1]['race']
+    assert server.pending == 0 and not server.in_flight
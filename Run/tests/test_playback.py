@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+import playback
+
+def test_log_clips_positions_to_the_track(tmp_path):
+    # A backwards first step and an overshot finish would wrap around as uint16s if they weren't clipped
+    snapshots = [(1, np.array([-3.2, 14.0])), (2, np.array([20.5, 1250.0]))]
+    path = tmp_path / 'race.log'
+    assert list(playback.write_log(path, ['A', 'B'], 1200, iter(snapshots))) == snapshots
+    header, read = playback.read_log(path)
+    assert header == {'names': ['A', 'B'], 'distance': 1200}
+    read = list(read)
+    assert [second for second, _ in read] == [1, 2]
+    np.testing.assert_allclose(read[0][1], [0.0, 14.0])
+    np.testing.assert_allclose(read[1][1], [20.5, 1200.0])
+
+def test_log_refuses_races_too_long_to_encode(tmp_path):
+    with pytest.raises(ValueError):
+        next(playback.write_log(tmp_path / 'race.log', ['A'], 7000, iter([(1, np.array([10.0]))])))
@@ -0,0 +1,62 @@
+import numpy as np
+from race import Track, Race
+
+def test_real_horses_race_at_distance_without_data(real_horse):
+    # 2000 meters has no rows in the database, which only matters to created horses
+    track = Track(2000, use_snapshot=False)
+    horses = [real_horse(f'Horse {i}', mps_mean=(16.5 - i/10, 15.8 - i/10)) for i in range(4)]
+    race = Race(horses, track, len(horses), sims=200, use_cache=False)
+    assert set(race.odds) == {horse.name for horse in horses}
+    assert len(race.simulate_race()) == len(horses)
+    assert 'velocity_table' not in vars(track) # The rating tables were never built
+
+def test_two_horse_race_prices_every_market(real_horse):
+    horses = [real_horse('Horse 0'), real_horse('Horse 1', mps_mean=(16.3, 15.6))]
+    race = Race(horses, Track(1200, use_snapshot=False), 2, sims=300, use_cache=False)
+    assert race.results['exacta'].sum() == 300
+    assert race.results['trifecta'].sum() == 0 # No third place to bet on
+    bets = race.get_bet_probabilities()
+    assert sum(bets['win'].values()) == 1 and bets['show'] == {'Horse 0': 1.0, 'Horse 1': 1.0}
+    assert bets['trifecta'] == {}
+
+def test_one_horse_race(real_horse):
+    race = Race([real_horse('Alone')], Track(1200, use_snapshot=False), 1, sims=50, use_cache=False)
+    assert race.results['wins'].tolist() == [50]
+    assert race.get_bet_probabilities()['exacta'] == {}
+
+def test_lopsided_field_settles_well_below_the_cap(real_horse):
+    # Long shots' rounded odds change every few hundredths of a percent, so they settle by the width of their interval
+    horses = [real_horse('Favorite', mps_mean=(17.0, 16.3))] + [real_horse(f'Horse {i}', mps_mean=(16.5 - i/20, 15.8 - i/20))
+                                                                 for i in range(5)]
+    race = Race(horses, Track(1200, use_snapshot=False), len(horses), sims='auto', seed=1, use_cache=False)
+    assert race.adaptive['converged']
+    assert race.sims <= Race.MAX_SIMS//8
+    assert max(race.adaptive['widths'].values()) < 0.05
+
+def test_odds_steps_match_the_rounding():
+    steps = Race.get_odds_steps()
+    assert (steps[1:] > steps[:-1]).all()
+    # 5-1 becomes 4-1 at a 1 in 5 chance, and 1-4 becomes 1-5 at a 4 in 5 chance
+    assert abs(steps - 1/5).min() < 1e-9 and abs(steps - 4/5).min() < 1e-9
+
+def test_preprocess_draws_the_whole_field(real_horse):
+    horses = [real_horse('Steady', stdev_stats=(0.3, 0.3, 0.0)), real_horse('Other')]
+    race = Race(horses, Track(1200, use_snapshot=False), 2, get_odds=False)
+    velocity, stdev, fatigue = race.preprocess()
+    assert stdev[0] == 0.3 and fatigue.tolist() == [0.2, 0.2] # No spread in either
+    assert [horse.velocity for horse in horses] == velocity.tolist() and horses[1].stdev == stdev[1]
+    assert not race.winner
+
+def test_seeded_results_do_not_depend_on_workers(real_horse):
+    horses = [real_horse(f'Horse {i}', mps_mean=(16.5 - i/10, 15.8 - i/10)) for i in range(4)]
+    race = Race(horses, Track(1200, use_snapshot=False), len(horses), get_odds=False)
+    one, two, three = (race.simulate_races(sims=5500, chunk_size=1000, workers=workers, seed=7) for workers in (1, 2, 3))
+    for key in one:
+        assert np.array_equal(one[key], two[key]) and np.array_equal(one[key], three[key]), key
+    # The same holds for count_races when its chunks' seeds are split into shares by hand
+    params = race.get_params()
+    seeds = np.random.SeedSequence(7).spawn(6)
+    whole, = Race.count_races(params, [4], 1200, 5500, 1000, seeds=seeds)
+    shares = Race.merge_results([Race.count_races(params, [4], 1200, 3000, 1000, seeds=seeds[:3])[0],
+                                 Race.count_races(params, [4], 1200, 2500, 1000, seeds=seeds[3:])[0]])
+    assert all(np.array_equal(whole[key], shares[key]) for key in whole)
@@ -0,0 +1,38 @@
+import os
+import requests
+from scraper import HorseFetcher
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'fixtures')
+
+class FakeSession:
+    # Answers every request with the same status and page, instead of going to horseracingnation.com
+    def __init__(self, status, html=''):
+        self.status = status
+        self.html = html
+
+    def get(self, url, timeout=None):
+        response = requests.Response()
+        response.status_code = self.status
+        response._content = self.html.encode()
+        response.url = url
+        return response
+
+def make_fetcher(tmp_path, status, html=''):
+    fetcher = HorseFetcher(cache_dir=str(tmp_path))
+    fetcher.session = FakeSession(status, html)
+    return fetcher
+
+def test_error_pages_are_not_cached(tmp_path):
+    with open(os.path.join(FIXTURE_DIR, 'Swift_Runner.html')) as f:
+        html = f.read() # Even a page with a results table isn't used when the server says it's an error
+    fetcher = make_fetcher(tmp_path, 503, html)
+    times = fetcher.get_all_times(['Swift Runner'])
+    assert len(times['Swift Runner']) == 0
+    assert os.listdir(tmp_path) == []
+
+def test_pages_are_cached(tmp_path):
+    with open(os.path.join(FIXTURE_DIR, 'Swift_Runner.html')) as f:
+        fetcher = make_fetcher(tmp_path, 200, f.read())
+    times = fetcher.get_all_times(['Swift Runner'])
+    assert len(times['Swift Runner']) > 0
+    assert os.path.exists(fetcher.get_cache_path('Swift Runner'))
@@ -0,0 +1,32 @@
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import season
+from season import Season
+
+def test_sampled_horses_keep_the_tracks_ratings():
+    # Ratings come from every horse at the distance, not just the sampled ones
+    everyone = Season.from_db(1200)
+    ratings = dict(zip(everyone.names, map(tuple, everyone.ratings)))
+    sampled = Season.from_db(1200, num_horses=40, seed=0)
+    assert len(sampled.names) == 40
+    assert all(ratings[name] == tuple(rating) for name, rating in zip(sampled.names, sampled.ratings))
+
+def test_horses_missing_stats_are_left_out(monkeypatch):
+    grouped = pd.DataFrame({'horse_id': range(16), 'num_races': 10, 'top_speed': np.linspace(70, 75, 16)})
+    stats = pd.DataFrame({'horse_id': range(16), 'mps_std': np.linspace(0.1, 0.5, 16), 'time_diff': np.linspace(1, 3, 16)})
+    stats.loc[3, 'mps_std'] = np.nan
+    track = SimpleNamespace(grouped_data=grouped, horse_stats=stats)
+    monkeypatch.setattr(season, 'get_track', lambda distance: track)
+    horses = Season.from_db(1200, distances=[])
+    assert len(horses.names) == 15 and 'Horse 3' not in horses.names
+    assert horses.ratings.min() >= 1 and horses.ratings.max() <= 8
+
+def test_one_horse_fields_win_every_race():
+    horses = Season.from_names(5, seed=0, field=1, distances=[1200])
+    assert horses.run_round() == 5
+    assert horses.wins.tolist() == [1]*5 and (horses.form > 0).all()
+
+def test_seeded_season_is_reproducible():
+    standings = [list(Season.from_names(60, seed=4, distances=[1200, 1400]).run(rounds=3))[-1]['leaders'] for _ in range(2)]
+    assert standings[0].equals(standings[1]) and standings[0]['starts'].max() == 3
@@ -1,7 +1,11 @@
 from math import ceil
+from functools import lru_cache
+import numpy as np
 
 def convert_to_odds(wins, trials):
-    '''Converts wins and trials into odds ratio'''
+    '''Converts wins and trials into odds ratio. wins can also be an array of win counts.'''
+    if np.ndim(wins) > 0:
+        return convert_to_odds_array(wins, trials)
     numer = 1 - (wins/trials)
     denom = wins/trials
     scalar = 1/denom
@@ -13,40 +17,71 @@ def convert_to_odds(wins, trials):
         numer = 1
     return (numer, denom)
 
+def convert_to_odds_array(wins, trials):
+    '''
+    Converts an array of win counts into arrays of odds ratio numerators and denominators,
+    doing the same arithmetic as convert_to_odds so the results are identical.
+    '''
+    p = np.asarray(wins, dtype=float)/trials
+    numer = (1 - p)*(1/p)
+    minus = numer < 1 # Horses expected to win more than they lose
+    denom = np.where(minus, 100/(numer*100), 1)
+    rounded = np.round(denom, 5)
+    # np.round scales by 10^5 and can land on the other side of a tie than Python's exact round,
+    # so values close to a tie are rounded by Python
+    scaled = denom*10**5
+    close = minus & (np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    rounded[close] = [round(value, 5) for value in denom[close]]
+    return np.where(minus, 1, numer), np.where(minus, rounded, denom)
+
+def win_interval(wins, trials, z):
+    '''
+    Returns the lower and upper bounds of the (Wilson score) confidence interval
+    of a win probability, z standard errors wide. Works on arrays of wins.
+    '''
+    p = wins/trials
+    scale = 1 + z**2/trials
+    center = (p + z**2/(2*trials))/scale
+    half_width = z*((p*(1-p)/trials + z**2/(4*trials**2))**0.5)/scale
+    return center - half_width, center + half_width
+
 def round_plus(frac_tuple):
     '''Turn plus odds into a clean odds ratio'''
     numer, denom = frac_tuple
-    if numer >= 4 and denom == 1: # If the numerator is high enough just round it down (simulates 'juice'/tax added by sports books)
-        numer = numer//1
-        return (int(numer), int(denom))
-    elif denom == 4: # The denominator typically doesn't go much higher than 4 in most sports books, just round numerator down at this point
-        return (int(numer//1), int(denom//1))
-    elif numer % 1 < 0.5: # If the numerator rounds down, just return the rounded numerator (simulates 'juice'/tax)
-        return (int(numer//1), int(denom//1))
-    else:
-        return round_plus((numer*2, denom*2)) # If the numerator rounds up, multiply the ratio by two until 
-                                              # either the denominator is 4 or the numerator rounds down
+    while True:
+        if numer >= 4 and denom == 1: # If the numerator is high enough just round it down (simulates 'juice'/tax added by sports books)
+            numer = numer//1
+            return (int(numer), int(denom))
+        elif denom == 4: # The denominator typically doesn't go much higher than 4 in most sports books, just round numerator down at this point
+            return (int(numer//1), int(denom//1))
+        elif numer % 1 < 0.5: # If the numerator rounds down, just return the rounded numerator (simulates 'juice'/tax)
+            return (int(numer//1), int(denom//1))
+        # If the numerator rounds up, multiply the ratio by two until 
+        # either the denominator is 4 or the numerator rounds down
+        numer, denom = numer*2, denom*2
 
 def round_minus(frac_tuple):
     '''Turn minus odds into clean odds ratio'''
     # Everything here is the opposite of round_plus function
     numer, denom = frac_tuple
-    if denom >= 4 and numer == 1: # If the denominator gets high enough just round up (simulates 'juice')
-        denom = ceil(denom)
-        return (int(numer), int(denom))
-    elif numer == 4: # The numerator typically doesn't go much higher than 4 in most sports books, just round denominator up at this point
-        return (int(ceil(numer)), int(ceil(denom)))
-    elif denom % 1 >= 0.5: #If the denominator rounds up, just return the rounded numerator (simulates 'juice'/tax)
-        return (int(round(numer)), int(round(denom)))
-    else:
-        return round_minus((numer*2, denom*2))# If the denominator rounds down, multiply the ratio by two until 
-                                              # either the numerator is 4 or the denominator rounds up
+    while True:
+        if denom >= 4 and numer == 1: # If the denominator gets high enough just round up (simulates 'juice')
+            denom = ceil(denom)
+            return (int(numer), int(denom))
+        elif numer == 4: # The numerator typically doesn't go much higher than 4 in most sports books, just round denominator up at this point
+            return (int(ceil(numer)), int(ceil(denom)))
+        elif denom % 1 >= 0.5: #If the denominator rounds up, just return the rounded numerator (simulates 'juice'/tax)
+            return (int(round(numer)), int(round(denom)))
+        # If the denominator rounds down, multiply the ratio by two until 
+        # either the numerator is 4 or the denominator rounds up
+        numer, denom = numer*2, denom*2
 
+@lru_cache(maxsize=4096)
 def round_odds(frac_tuple):
     '''
     Returns odds converted into a clean (integer) odds ratio. Through rounding,
     'juice' or tax is also incorporated to simulate what sportsbooks do with 
-    their odds. 
+    their odds. Results are cached since the same odds come up again and again.
     '''
     numer, denom = frac_tuple
     if numer > denom: # Plus odds are when a horse is not expected to win (<50% chance)
@@ -57,6 +92,28 @@ def round_odds(frac_tuple):
         return (1, 1)
     else:
         return odds
+
+def round_odds_array(numer, denom):
+    '''
+    Returns round_odds of arrays of odds ratios from convert_to_odds_array, as arrays of numerators and denominators.
+    Since either the numerator or the denominator starts at 1, round_plus and round_minus double the ratio
+    at most twice, so every case is worked out at once instead of one ratio at a time.
+    '''
+    numer = np.asarray(numer, dtype=float)
+    denom = np.asarray(denom, dtype=float)
+    # Plus odds (x, 1): x rounded down, unless it would round up, then doubled (2x, 2), then (4x, 4)
+    x = numer
+    plus_numer = np.select([(x >= 4) | (x % 1 < 0.5), (2*x) % 1 < 0.5], [x//1, (2*x)//1], (4*x)//1)
+    plus_denom = np.select([(x >= 4) | (x % 1 < 0.5), (2*x) % 1 < 0.5], [1, 2], 4)
+    # Minus odds (1, y): y rounded up when it's at least 4, otherwise rounded if it would round up, then doubled
+    y = denom
+    minus_numer = np.select([y >= 4, y % 1 >= 0.5, (2*y) % 1 >= 0.5], [1, 1, 2], 4)
+    minus_denom = np.select([y >= 4, y % 1 >= 0.5, (2*y) % 1 >= 0.5], [np.ceil(y), np.round(y), np.round(2*y)], np.ceil(4*y))
+    plus = numer > denom
+    numer = np.where(plus, plus_numer, minus_numer).astype(int)
+    denom = np.where(plus, plus_denom, minus_denom).astype(int)
+    even = numer == denom
+    return np.where(even, 1, numer), np.where(even, 1, denom)
     
 def mixed_to_float(mixed_str):
     '''Turned mixed number strings into floats.'''
@@ -97,6 +154,14 @@ def miles_to_meters(mile_text):
     meters = miles * 1600
     return meters
 
+def parse_distance(text):
+    '''Converts a distance typed on the website (like 6f, 1mi, 1200m, or 1200) into meters.'''
+    if 'f' in text:
+        return furlongs_to_meters(text.replace('f','F'))
+    if 'mi' in text:
+        return miles_to_meters(text.replace('mi','M'))
+    return float(text.replace('m',''))
+
 def convert_to_meters(dist_str):
     '''Converts a distance string into meters whether it's in furlongs or miles.'''
     if dist_str[-1] == 'F' or dist_str[-1] == 'f':